@@ -0,0 +1,135 @@
+import asyncio
+import concurrent.futures
+import sys
+import threading
+import websockets
+
+from connection import WotConnection, _message_size, parse_args, open_world, close_world
+
+class AsyncWotServer(WotConnection):
+	"""
+	A connection to a client, served by asyncio.
+	
+	Messages are handled in an executor, so that one connection waiting for
+	the pool's lock or the db doesn't block the other connections. Each
+	connection has its own send coroutine, so a slow client only delays
+	itself.
+	"""
+	
+	def __init__(self, websocket, loop):
+		self.websocket = websocket
+		self.loop = loop
+		self.address = websocket.remote_address
+		
+		self._outbox = asyncio.Queue()
+		self._backlog = 0 # bytes in the outbox
+		self._backlog_lock = threading.Lock()
+	
+	def sendMessage(self, data):
+		# called from the executor's threads
+		size = _message_size(data)
+		with self._backlog_lock:
+			self._backlog += size
+		self.loop.call_soon_threadsafe(self._outbox.put_nowait, (data, size))
+	
+	def backlog(self):
+		return self._backlog
+	
+	def drop(self):
+		self.loop.call_soon_threadsafe(self._drop)
+	
+	def _drop(self):
+		# don't wait for the backlog before closing
+		while not self._outbox.empty():
+			self._outbox.get_nowait()
+		
+		asyncio.ensure_future(self.websocket.close(1008, "Too slow"))
+	
+	async def send_loop(self):
+		while True:
+			data, size = await self._outbox.get()
+			await self.websocket.send(data)
+			
+			with self._backlog_lock:
+				self._backlog -= size
+	
+	async def serve(self):
+		self.connected()
+		sender = asyncio.ensure_future(self.send_loop())
+		
+		try:
+			async for message in self.websocket:
+				# one message at a time, so they are handled in order
+				try:
+					await self.loop.run_in_executor(self.executor, self.handle_message, message)
+				except (ValueError, KeyError, TypeError, IndexError):
+					# a malformed message, close the connection like SimpleWebSocketServer does
+					await self.websocket.close(1007, "Malformed message")
+					break
+		except websockets.exceptions.ConnectionClosed:
+			pass
+		finally:
+			sender.cancel()
+			self.disconnected()
+
+async def flush_loop():
+	loop = asyncio.get_event_loop()
+	resyncing = None
+	
+	while True:
+		await asyncio.sleep(AsyncWotServer.flush_period)
+		AsyncWotServer.flush_all()
+		
+		# resyncing reads chunks from the pool, which mustn't block the event loop
+		if not resyncing or resyncing.done():
+			resyncing = loop.run_in_executor(AsyncWotServer.executor, AsyncWotServer.resync_all)
+
+async def serve(port):
+	loop = asyncio.get_event_loop()
+	
+	async def handler(websocket, path=None):
+		await AsyncWotServer(websocket, loop).serve()
+	
+	server = await websockets.serve(handler, None, port)
+	try:
+		await flush_loop() # serve forever
+	finally:
+		server.close()
+		await server.wait_closed()
+
+def run(port, max_workers=8):
+	"""
+	Serve the world opened with open_world() until interrupted, then close it.
+	"""
+	
+	AsyncWotServer.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+	
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	task = loop.create_task(serve(port))
+	try:
+		loop.run_until_complete(task)
+	except KeyboardInterrupt:
+		# the server has to be closed while the loop is still running
+		task.cancel()
+		try:
+			loop.run_until_complete(task)
+		except (asyncio.CancelledError, KeyboardInterrupt):
+			pass
+		
+		AsyncWotServer.executor.shutdown()
+		close_world(AsyncWotServer)
+	finally:
+		loop.close()
+
+def main(argv):
+	args = parse_args(argv)
+	if not args:
+		return
+	
+	dbfile, port, stats_period = args
+	open_world(AsyncWotServer, dbfile, stats_period)
+	run(port)
+
+if __name__ == "__main__":
+	main(sys.argv)
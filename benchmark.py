@@ -0,0 +1,331 @@
+"""
+Benchmarks for the server.
+
+  python benchmark.py micro
+    Times ChunkDiff operations, ChunkPool.commit_changes and ChunkDB.save_many.
+
+  python benchmark.py load [options]
+    Starts a server on loopback with a temporary db and connects simulated
+    clients to it which type and scroll. See --help for the options.
+"""
+
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import websocket
+
+import protocol
+from chunks import ChunkDiff, Chunk, ChunkPool, split_legitimate
+from dbchunkpool import ChunkDB
+from utils import Position, CHUNK_WIDTH, CHUNK_HEIGHT
+
+def percentile(values, p):
+	if not values:
+		return float("nan")
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values)*p))]
+
+def peak_memory(pid):
+	"""
+	Returns the peak resident memory of a process in KiB, if the OS tells us.
+	"""
+	
+	try:
+		with open("/proc/{}/status".format(pid)) as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1])
+	except OSError:
+		pass
+
+## micro benchmarks
+
+def micro(args):
+	def report(name, func, number):
+		seconds = min(timeit.repeat(func, number=number, repeat=3))
+		print("{:<40} {:>10.2f} µs".format(name, seconds/number*1e6))
+	
+	content = "".join(random.choice("abc   ") for _ in range(CHUNK_WIDTH*CHUNK_HEIGHT))
+	full = ChunkDiff.from_string(content)
+	sparse = ChunkDiff.from_dict({random.randrange(CHUNK_WIDTH*CHUNK_HEIGHT): "x" for _ in range(8)})
+	chunk = Chunk.from_string(content)
+	chunk.apply_diff(sparse)
+	
+	report("ChunkDiff.from_string", lambda: ChunkDiff.from_string(content), 10000)
+	# copies, since diffs cache their encodings
+	report("ChunkDiff.to_string", lambda: full.copy().to_string(), 10000)
+	report("ChunkDiff.combine (full + sparse)", lambda: full.combine(sparse), 10000)
+	report("ChunkDiff.apply (full)", lambda: full.copy().apply(full), 10000)
+	report("ChunkDiff.clear_deletions", lambda: full.copy().clear_deletions(), 10000)
+	report("ChunkDiff.diff (sparse)", lambda: sparse.diff(full), 10000)
+	report("ChunkDiff.legitimate", lambda: full.copy().legitimate(), 10000)
+	batch = {Position(x, 0): sparse for x in range(64)}
+	report("split_legitimate (64 sparse)", lambda: split_legitimate(batch), 1000)
+	report("ChunkDiff.to_dict (full)", lambda: full.copy().to_dict(), 1000)
+	report("ChunkDiff.from_dict (sparse)", lambda: ChunkDiff.from_dict(sparse.to_dict()), 10000)
+	report("ChunkDiff.to_bytes (full)", lambda: full.copy().to_bytes(), 10000)
+	report("Chunk.as_diff", chunk.as_diff, 10000)
+	report("Chunk.lines", chunk.lines, 10000)
+	
+	def commit_changes():
+		pool = ChunkPool()
+		for x in range(args.chunks):
+			pool.create(Position(x, 0)).apply_diff(sparse)
+		pool.commit_changes()
+	report("ChunkPool.commit_changes ({} chunks)".format(args.chunks), commit_changes, 10)
+	
+	with tempfile.TemporaryDirectory() as directory:
+		db = ChunkDB(os.path.join(directory, "bench.db"))
+		chunks = {Position(x, 0): Chunk.from_string(content) for x in range(args.chunks)}
+		report("ChunkDB.save_many ({} chunks)".format(args.chunks), lambda: db.save_many(chunks), 10)
+		report("ChunkDB.load_many ({} chunks)".format(args.chunks), lambda: db.load_many(chunks.keys()), 10)
+		db.close()
+
+## load generation
+
+class SimulatedClient():
+	"""
+	A client that subscribes to a rectangle of chunks, and optionally types
+	into its home chunk or scrolls back and forth.
+	"""
+	
+	def __init__(self, bench, x, y, binary):
+		self.bench = bench
+		self.x = x
+		self.y = y
+		self.binary = binary
+		
+		self.sent_edits = 0
+		self.received_messages = 0
+		self.received_bytes = 0
+		self.features = set()
+		self.requested = {} # pos -> time the chunk was last requested
+		
+		self._ws = websocket.create_connection(bench.address, enable_multithread=True)
+		if binary:
+			self._ws.send(json.dumps({"type": "hello", "data": ["binary"]}))
+		
+		self.receive_thread = threading.Thread(target=self.receive_loop, daemon=True)
+		self.receive_thread.start()
+	
+	def rect(self):
+		return [Position(x, y)
+		        for x in range(self.x, self.x + self.bench.view_width)
+		        for y in range(self.y, self.y + self.bench.view_height)]
+	
+	def request(self, coords):
+		now = time.time()
+		for pos in coords:
+			self.requested[pos] = now
+		self.send("request-chunks", coords)
+	
+	def send(self, mtype, data):
+		if "binary" in self.features:
+			self._ws.send_binary(protocol.encode_binary(mtype, data))
+		else:
+			self._ws.send(protocol.encode_json(mtype, data))
+	
+	def receive_loop(self):
+		try:
+			while True:
+				message = self._ws.recv()
+				if not message:
+					break
+				
+				now = time.time()
+				self.received_messages += 1
+				self.received_bytes += len(message)
+				
+				mtype, data, versions = protocol.decode(message)
+				if mtype == "hello":
+					self.features = set(data)
+				elif mtype == "apply-changes":
+					self.bench.received(self, data, now)
+		except (websocket.WebSocketException, OSError):
+			pass
+	
+	def type(self, i):
+		pos = Position(self.x, self.y)
+		index = i%(CHUNK_WIDTH*CHUNK_HEIGHT)
+		char = chr(ord("a") + i%26)
+		
+		self.bench.sent(pos, index, char)
+		self.send("save-changes", {pos: ChunkDiff.from_dict({index: char})})
+		self.sent_edits += 1
+	
+	def scroll(self, dx):
+		before = set(self.rect())
+		self.x += dx
+		after = set(self.rect())
+		
+		self.send("unload-chunks", list(before - after))
+		self.request(list(after - before))
+	
+	def close(self):
+		self._ws.close()
+
+class LoadBenchmark():
+	def __init__(self, args):
+		self.args = args
+		self.view_width = args.view_width
+		self.view_height = args.view_height
+		
+		self._sent = {}
+		self._seen = set()
+		self._latencies = []
+		self._lock = threading.Lock()
+	
+	def sent(self, pos, index, char):
+		with self._lock:
+			self._sent[(pos, index)] = (char, time.time())
+	
+	def received(self, client, diffs, now):
+		"""
+		Only counts the first time a client sees an edit, and not if the edit
+		arrived as part of a chunk the client requested after the edit was made.
+		"""
+		
+		latencies = []
+		with self._lock:
+			for pos, diff in diffs.items():
+				for index, char in diff.to_dict().items():
+					sent = self._sent.get((pos, index))
+					if not sent or sent[0] != char or sent[1] < client.requested.get(pos, 0):
+						continue
+					
+					key = (client, pos, index, sent[1])
+					if key not in self._seen:
+						self._seen.add(key)
+						latencies.append(now - sent[1])
+			self._latencies.extend(latencies)
+	
+	def start_server(self, directory):
+		with socket.socket() as s:
+			s.bind(("127.0.0.1", 0))
+			port = s.getsockname()[1]
+		
+		self.address = "ws://127.0.0.1:{}/".format(port)
+		script = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.args.server + ".py")
+		self.server = subprocess.Popen(
+			[sys.executable, script, os.path.join(directory, "bench.db"), str(port)],
+			stdout=subprocess.DEVNULL
+		)
+		
+		# wait until the server accepts connections
+		for _ in range(100):
+			try:
+				socket.create_connection(("127.0.0.1", port)).close()
+				return
+			except OSError:
+				time.sleep(.1)
+		raise RuntimeError("Server didn't start")
+	
+	def stop_server(self):
+		self.server.send_signal(signal.SIGINT)
+		self.server.wait()
+	
+	def run(self):
+		args = self.args
+		
+		with tempfile.TemporaryDirectory() as directory:
+			self.start_server(directory)
+			try:
+				typists = [SimulatedClient(self, 2*i%args.world, 0, args.binary) for i in range(args.typists)]
+				viewers = [SimulatedClient(self, 0, 0, args.binary) for i in range(args.viewers)]
+				clients = typists + viewers
+				
+				time.sleep(.2) # wait for hello
+				for client in clients:
+					client.request(client.rect())
+				
+				stop = time.time() + args.duration
+				threads = [threading.Thread(target=self.type_loop, args=(client, stop)) for client in typists]
+				threads += [threading.Thread(target=self.scroll_loop, args=(client, stop)) for client in viewers]
+				
+				start = time.time()
+				for thread in threads:
+					thread.start()
+				for thread in threads:
+					thread.join()
+				time.sleep(.5) # let the last broadcasts arrive
+				duration = time.time() - start
+				
+				memory = peak_memory(self.server.pid)
+				
+				for client in clients:
+					client.close()
+			finally:
+				self.stop_server()
+		
+		edits = sum(client.sent_edits for client in typists)
+		messages = sum(client.received_messages for client in clients)
+		received = sum(client.received_bytes for client in clients)
+		
+		print("server:            {}".format(args.server))
+		print("clients:           {} typing, {} scrolling".format(len(typists), len(viewers)))
+		print("protocol:          {}".format("binary" if args.binary else "json"))
+		print("edits sent:        {} ({:.0f}/s)".format(edits, edits/duration))
+		print("messages received: {} ({:.0f}/s)".format(messages, messages/duration))
+		print("bytes received:    {} ({:.0f}/s)".format(received, received/duration))
+		print("broadcast latency: p50 {:.1f} ms, p99 {:.1f} ms ({} samples)".format(
+			percentile(self._latencies, .5)*1000,
+			percentile(self._latencies, .99)*1000,
+			len(self._latencies)
+		))
+		if memory:
+			print("server peak rss:   {} KiB".format(memory))
+	
+	def type_loop(self, client, stop):
+		i = 0
+		while time.time() < stop:
+			client.type(i)
+			i += 1
+			time.sleep(1/self.args.type_rate)
+	
+	def scroll_loop(self, client, stop):
+		direction = 1
+		while time.time() < stop:
+			if not 0 <= client.x + direction <= self.args.world:
+				direction = -direction
+			client.scroll(direction)
+			time.sleep(1/self.args.scroll_rate)
+
+def load(args):
+	LoadBenchmark(args).run()
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Benchmarks for the wot server")
+	subparsers = parser.add_subparsers(dest="benchmark")
+	subparsers.required = True
+	
+	parser_micro = subparsers.add_parser("micro", help="time chunk, pool and db operations")
+	parser_micro.add_argument("--chunks", type=int, default=1000, help="chunks for the pool and db benchmarks")
+	parser_micro.set_defaults(func=micro)
+	
+	parser_load = subparsers.add_parser("load", help="run simulated clients against a server")
+	parser_load.add_argument("--server", choices=["server", "aioserver", "shardserver"], default="server")
+	parser_load.add_argument("--typists", type=int, default=10, help="clients that type")
+	parser_load.add_argument("--viewers", type=int, default=50, help="clients that scroll")
+	parser_load.add_argument("--duration", type=float, default=10, help="in seconds")
+	parser_load.add_argument("--type-rate", type=float, default=5, help="characters per second per typist")
+	parser_load.add_argument("--scroll-rate", type=float, default=2, help="chunks per second per viewer")
+	parser_load.add_argument("--world", type=int, default=20, help="width of the area the clients use, in chunks")
+	parser_load.add_argument("--view-width", type=int, default=7, help="in chunks")
+	parser_load.add_argument("--view-height", type=int, default=5, help="in chunks")
+	parser_load.add_argument("--binary", action="store_true", help="use the binary protocol")
+	parser_load.set_defaults(func=load)
+	
+	args = parser.parse_args(argv[1:])
+	args.func(args)
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -1,48 +1,212 @@
-import string
+import re
+import struct
+import sys
 import threading
 import time
+import zlib
+from array import array
+from contextlib import contextmanager
 from utils import CHUNK_WIDTH, CHUNK_HEIGHT, Position
 
+CHUNK_SIZE = CHUNK_WIDTH*CHUNK_HEIGHT
+FULL_MASK = (1 << CHUNK_SIZE) - 1
+
+# code points are stored as 32 bit unsigned ints, which lets us convert a whole
+# buffer from and to a string in one go via the matching utf-32 codec
+_CODEPOINTS = "I"
+_ENCODING = "utf-32-le" if sys.byteorder == "little" else "utf-32-be"
+_BLANK = array(_CODEPOINTS, [ord(" ")])*CHUNK_SIZE
+_NONBLANK = re.compile("[^ ]")
+_ILLEGITIMATE = re.compile("[\x00-\x1f]") # control characters and whitespace other than " "
+
+# binary encoding of a diff: kind, cells, payload length, payload
+# The cells are a mask, or for diffs with few cells (where it's shorter) their
+# count and indices, lowest first. The payload contains the utf-8 encoded
+# characters of these cells.
+_DIFF_HEADER = struct.Struct("<B")
+_PAYLOAD_HEADER = struct.Struct("<H")
+_INDEX = struct.Struct("<H")
+_MASK_BYTES = (CHUNK_SIZE + 7)//8
+_KIND_PARTIAL = 0 # only the cells in the mask are part of the diff
+_KIND_FULL = 1    # all cells are part of the diff, the ones not in the mask are " "
+_KIND_INDICES = 2 # added to the kind if the cells are sent as indices instead of a mask
+_POSITION = struct.Struct("<ii")
+_DIFF_VERSIONS = struct.Struct("<qq") # base version, version
+_VERSIONED_POSITION = struct.Struct("<iiqI") # x, y, version, checksum
+
+def _indices(mask):
+	"""
+	Yields the index of every bit set in mask, lowest first.
+	"""
+	
+	while mask:
+		low = mask & -mask
+		yield low.bit_length() - 1
+		mask ^= low
+
+def _nonblank_mask(s):
+	"""
+	Returns a mask with a bit set for every character in s that is not " ".
+	"""
+	
+	bits = _NONBLANK.sub("1", s).replace(" ", "0")
+	return int(bits[::-1], 2) if bits else 0
+
 class ChunkDiff():
 	"""
 	Represents differences between two chunks (changes to be made to a chunk).
 	Can be used to transform a chunk into another chunk.
 	
+	The cells are stored as a fixed-size buffer of code points, with a bitmask
+	marking which cells are part of the diff. Cells that aren't part of the
+	diff always contain a " ".
+	
+	to_string(), to_bytes() and to_dict() are only computed once until the
+	diff is changed, so their results must not be modified.
+	
 	Todo: Implement delete diff
 	"""
 	
 	def __init__(self):
-		self._chars = {}
+		self._buf = array(_CODEPOINTS, _BLANK)
+		self._mask = 0
+		self._invalid = 0 # mask of the cells from_dict() couldn't store
+		self._cache = {} # results of to_string(), to_bytes(), to_dict() and checksum()
 	
 	def __str__(self):
-		return "cd" + str(self._chars)
+		return "cd" + str(self.to_dict())
 	
 	def __repr__(self):
-		return "cd" + repr(self._chars)
+		return "cd" + repr(self.to_dict())
 	
 	@classmethod
 	def from_dict(cls, d):
 		diff = cls()
-		diff._chars = {int(i): v for i, v in d.items()}
+		for i, char in d.items():
+			i = int(i)
+			if not 0 <= i < CHUNK_SIZE:
+				continue # not a cell, so there's nothing to correct either
+			elif isinstance(char, str) and len(char) == 1:
+				diff._buf[i] = ord(char)
+				diff._mask |= 1 << i
+			else:
+				# keep the cell so the sender can be sent a correction for it
+				diff._mask |= 1 << i
+				diff._invalid |= 1 << i
 		return diff
 	
 	def to_dict(self):
-		return self._chars
-		#return self._chars.copy()
+		d = self._cache.get("dict")
+		if d is None:
+			buf = self._buf
+			d = {i: chr(buf[i]) for i in _indices(self._mask)}
+			self._cache["dict"] = d
+		return d
 	
 	@classmethod
 	def from_string(cls, s):
+		s = s[:CHUNK_SIZE]
 		diff = cls()
-		for i, char in enumerate(s):
-			diff._chars[i] = char
+		diff._buf[:len(s)] = array(_CODEPOINTS, s.encode(_ENCODING, "surrogatepass"))
+		diff._mask = (1 << len(s)) - 1
 		return diff
 	
 	def to_string(self):
-		s = "".join(self._chars.get(i, " ") for i in range(CHUNK_WIDTH*CHUNK_HEIGHT))
+		s = self._cache.get("string")
+		if s is None:
+			s = self._buf.tobytes().decode(_ENCODING, "surrogatepass")
+			self._cache["string"] = s
 		return s
 	
+	@classmethod
+	def from_bytes(cls, data, offset=0):
+		"""
+		Returns the diff and the offset of the first byte after it.
+		Raises a ValueError if the data is malformed.
+		"""
+		
+		try:
+			kind, = _DIFF_HEADER.unpack_from(data, offset)
+			offset += _DIFF_HEADER.size
+			if kind & _KIND_INDICES:
+				kind -= _KIND_INDICES
+				count, = _INDEX.unpack_from(data, offset)
+				offset += _INDEX.size
+				indices = struct.unpack_from("<{}H".format(count), data, offset)
+				offset += count*_INDEX.size
+				
+				# in increasing order, so they match the order of the characters
+				if any(a >= b for a, b in zip(indices, indices[1:])) or (indices and indices[-1] >= CHUNK_SIZE):
+					raise ValueError("Malformed diff")
+				mask = sum(1 << i for i in indices)
+			else:
+				if len(data) < offset + _MASK_BYTES:
+					raise ValueError("Truncated diff")
+				mask = int.from_bytes(data[offset:offset+_MASK_BYTES], "little")
+				offset += _MASK_BYTES
+			length, = _PAYLOAD_HEADER.unpack_from(data, offset)
+			offset += _PAYLOAD_HEADER.size
+		except struct.error as e:
+			raise ValueError("Truncated diff") from e
+		
+		payload = bytes(data[offset:offset+length])
+		offset += length
+		if len(payload) != length:
+			raise ValueError("Truncated diff")
+		
+		chars = payload.decode("utf-8", "surrogatepass")
+		if kind not in (_KIND_PARTIAL, _KIND_FULL) or len(chars) != bin(mask).count("1"):
+			raise ValueError("Malformed diff")
+		
+		diff = cls()
+		buf = diff._buf
+		for i, char in zip(_indices(mask), chars):
+			buf[i] = ord(char)
+		diff._mask = FULL_MASK if kind == _KIND_FULL else mask
+		
+		return diff, offset
+	
+	def to_bytes(self):
+		data = self._cache.get("bytes")
+		if data is None:
+			data = self._to_bytes()
+			self._cache["bytes"] = data
+		return data
+	
+	def _to_bytes(self):
+		s = self.to_string()
+		
+		if self._mask == FULL_MASK:
+			# cells not in the diff are " " anyways, so only non-blank cells need to be sent
+			kind = _KIND_FULL
+			mask = _nonblank_mask(s)
+			chars = s.replace(" ", "")
+		else:
+			kind = _KIND_PARTIAL
+			mask = self._mask
+			chars = "".join(s[i] for i in _indices(mask))
+		
+		count = len(chars)
+		if (count + 1)*_INDEX.size < _MASK_BYTES:
+			cells = struct.pack("<{}H".format(count + 1), count, *_indices(mask))
+			kind += _KIND_INDICES
+		else:
+			cells = mask.to_bytes(_MASK_BYTES, "little")
+		
+		payload = chars.encode("utf-8", "surrogatepass")
+		return b"".join((
+			_DIFF_HEADER.pack(kind),
+			cells,
+			_PAYLOAD_HEADER.pack(len(payload)),
+			payload
+		))
+	
 	def copy(self):
-		return ChunkDiff.from_dict(self.to_dict().copy())
+		diff = ChunkDiff()
+		diff._buf = array(_CODEPOINTS, self._buf)
+		diff._mask = self._mask
+		diff._invalid = self._invalid
+		return diff
 	
 	def combine(self, diff):
 		newdiff = self.copy()
@@ -51,38 +215,110 @@ class ChunkDiff():
 	
 	def set(self, x, y, character):
 		pos = x+y*CHUNK_WIDTH
-		self._chars[pos] = character
+		self._buf[pos] = ord(character)
+		self._mask |= 1 << pos
+		self._cache.clear()
 	
 	def delete(self, x, y):
 		self.set(x, y, " ")
 	
 	def clear_deletions(self):
-		self._chars = {i: v for i, v in self._chars.items() if v != " "}
+		self._mask &= _nonblank_mask(self.to_string())
+		self._cache.clear()
 	
 	def apply(self, diff):
-		for i, c in diff._chars.items():
-			self._chars[i] = c
+		if diff._mask == FULL_MASK:
+			self._buf[:] = diff._buf
+		else:
+			buf, other = self._buf, diff._buf
+			for i in _indices(diff._mask):
+				buf[i] = other[i]
+		
+		self._mask |= diff._mask
+		self._cache.clear()
 	
 	def lines(self):
 		s = self.to_string()
-		return [s[i:i+CHUNK_WIDTH] for i in range(0, CHUNK_WIDTH*CHUNK_HEIGHT, CHUNK_WIDTH)]
+		return [s[i:i+CHUNK_WIDTH] for i in range(0, CHUNK_SIZE, CHUNK_WIDTH)]
+	
+	def checksum(self):
+		crc = self._cache.get("checksum")
+		if crc is None:
+			crc = zlib.crc32(self.to_string().encode("utf-8", "surrogatepass"))
+			self._cache["checksum"] = crc
+		return crc
 	
 	def empty(self):
-		return not bool(self._chars)
+		return not self._mask
 	
 	def legitimate(self):
-		for i, char in self._chars.items():
-			if not (isinstance(char, str) and len(char) == 1 and ord(char) > 31 and (char not in string.whitespace or char == " ")):
-				return False
-		else:
-			return True
+		return not self._invalid and not _ILLEGITIMATE.search(self.to_string())
+	
+	def split(self, mask):
+		"""
+		Returns two diffs: One with the cells that are not in mask, and one
+		with the cells that are.
+		"""
+		
+		mask &= self._mask
+		rest = self.copy()
+		part = ChunkDiff()
+		
+		for i in _indices(mask):
+			part._buf[i] = self._buf[i]
+			rest._buf[i] = _BLANK[i]
+		
+		rest._mask = self._mask & ~mask
+		rest._invalid = self._invalid & ~mask
+		part._mask = mask
+		part._invalid = self._invalid & mask
+		return rest, part
 	
 	def diff(self, chunk):
-		diffs = {}
-		for pos, char in self._chars.items():
-			diffs[pos] = chunk._chars.get(pos, " ")
+		newdiff = ChunkDiff()
+		if self._mask == FULL_MASK:
+			newdiff._buf[:] = chunk._buf
+		else:
+			buf, other = newdiff._buf, chunk._buf
+			for i in _indices(self._mask):
+				buf[i] = other[i]
 		
-		return ChunkDiff.from_dict(diffs)
+		newdiff._mask = self._mask
+		return newdiff
+
+def split_legitimate(diffs):
+	"""
+	Splits diffs into their legitimate and illegitimate cells.
+	Returns two dicts of diffs. Empty diffs are left out of both, so a
+	position only appears where it has cells.
+	
+	All diffs are checked in a single pass over their joined strings, which
+	is much faster than checking each of them for small diffs.
+	"""
+	
+	items = list(diffs.items())
+	bad_masks = [diff._invalid for pos, diff in items]
+	
+	# every diff's string is CHUNK_SIZE characters long
+	data = b"".join(diff._buf.tobytes() for pos, diff in items)
+	text = data.decode(_ENCODING, "surrogatepass")
+	for match in _ILLEGITIMATE.finditer(text):
+		n, i = divmod(match.start(), CHUNK_SIZE)
+		bad_masks[n] |= 1 << i
+	
+	legitimate = {}
+	illegitimate = {}
+	for (pos, diff), bad in zip(items, bad_masks):
+		if diff.empty():
+			continue
+		elif not bad:
+			legitimate[pos] = diff
+		elif bad == diff._mask:
+			illegitimate[pos] = diff
+		else:
+			legitimate[pos], illegitimate[pos] = diff.split(bad)
+	
+	return legitimate, illegitimate
 
 def jsonify_diffs(diffs):
 	ddiffs = []
@@ -101,6 +337,79 @@ def dejsonify_diffs(ddiffs):
 	
 	return diffs
 
+def pack_diffs(diffs, versions=None):
+	"""
+	If versions is given, each diff is followed by the base version and
+	version from versions (see protocol.py).
+	"""
+	
+	parts = []
+	for pos, diff in diffs.items():
+		parts.append(_POSITION.pack(pos[0], pos[1]))
+		parts.append(diff.to_bytes())
+		if versions is not None:
+			parts.append(_DIFF_VERSIONS.pack(*versions[pos]))
+	
+	return b"".join(parts)
+
+def unpack_diffs(data, offset=0, versions=None):
+	"""
+	If versions is given, the diffs' versions are added to it.
+	"""
+	
+	diffs = {}
+	while offset < len(data):
+		try:
+			x, y = _POSITION.unpack_from(data, offset)
+		except struct.error as e:
+			raise ValueError("Truncated position") from e
+		pos = Position(x, y)
+		diff, offset = ChunkDiff.from_bytes(data, offset + _POSITION.size)
+		diffs[pos] = diff
+		
+		if versions is not None:
+			try:
+				versions[pos] = _DIFF_VERSIONS.unpack_from(data, offset)
+			except struct.error as e:
+				raise ValueError("Truncated versions") from e
+			offset += _DIFF_VERSIONS.size
+	
+	return diffs
+
+def pack_coords(coords, versions=None):
+	"""
+	If versions is given, each position is followed by the version and
+	checksum from versions, or -1 and 0 if it has none (see protocol.py).
+	"""
+	
+	if versions is None:
+		return b"".join(_POSITION.pack(pos[0], pos[1]) for pos in coords)
+	
+	return b"".join(_VERSIONED_POSITION.pack(pos[0], pos[1], *versions.get(pos, (-1, 0))) for pos in coords)
+
+def unpack_coords(data, offset=0, versions=None):
+	"""
+	If versions is given, the versions and checksums are added to it.
+	"""
+	
+	if versions is None:
+		if (len(data) - offset)%_POSITION.size:
+			raise ValueError("Truncated position")
+		
+		return [Position(x, y) for x, y in _POSITION.iter_unpack(data[offset:])]
+	
+	if (len(data) - offset)%_VERSIONED_POSITION.size:
+		raise ValueError("Truncated position")
+	
+	coords = []
+	for x, y, version, checksum in _VERSIONED_POSITION.iter_unpack(data[offset:]):
+		pos = Position(x, y)
+		coords.append(pos)
+		if version >= 0:
+			versions[pos] = (version, checksum)
+	
+	return coords
+
 class Chunk():
 	"""
 	Represents a chunk (16x8 characters on the map).
@@ -108,13 +417,19 @@ class Chunk():
 	 - from another chunk
 	 - from direct changes
 	 - from accumulated changes
+	
+	The result of as_diff() and lines() is kept until the chunk is changed,
+	so readers of the same chunk version share it and must not modify it.
 	"""
 	
 	def __init__(self):
 		self._content = ChunkDiff()
 		self._modifications = ChunkDiff()
+		self._diff = None # cached as_diff()
+		self._lines = None # cached lines()
 		
 		self.last_modified = 0
+		self.version = 0 # increased by the server for every change, see DBChunkPool
 	
 	@classmethod
 	def from_string(cls, s):
@@ -127,35 +442,42 @@ class Chunk():
 	
 	def set(self, x, y, character):
 		self._modifications.set(x, y, character)
-		self.touch()
+		self._changed()
 	
 	def delete(self, x, y):
 		self._modifications.delete(x, y)
-		self.touch()
+		self._changed()
 	
 	def commit_changes(self):
 		self.commit_diff(self._modifications)
 		self._modifications = ChunkDiff()
-		self.touch()
+		self._changed()
 	
 	def apply_diff(self, diff):
 		self._modifications.apply(diff)
-		self.touch()
+		self._changed()
 	
 	def commit_diff(self, diff):
 		self._content.apply(diff)
 		self._content.clear_deletions()
-		self.touch()
+		self._changed()
 	
 	def drop_changes(self):
 		self._modifications = ChunkDiff()
+		self._changed()
+	
+	def _changed(self):
+		self._diff = None
+		self._lines = None
 		self.touch()
 	
 	def get_changes(self):
 		return self._modifications
 	
 	def as_diff(self):
-		return self._content.combine(self._modifications)
+		if self._diff is None:
+			self._diff = self._content.combine(self._modifications)
+		return self._diff
 	
 	def touch(self, now=None):
 		self.last_modified = now or time.time()
@@ -164,7 +486,12 @@ class Chunk():
 		return (now or time.time()) - self.last_modified
 	
 	def lines(self):
-		return self.as_diff().lines()
+		if self._lines is None:
+			self._lines = self.as_diff().lines()
+		return self._lines
+	
+	def checksum(self):
+		return self.as_diff().checksum()
 	
 	def modified(self):
 		return not self._modifications.empty()
@@ -177,21 +504,151 @@ class ChunkPool():
 	Is a collection of chunks.
 	Allows user to manage (get, modify, delete) chunks, keeps track of chunks for them.
 	Load chunks it doesn't know.
+	
+	Chunks are protected by a fixed number of locks (stripes), selected by the
+	chunk's position. lock_chunks() only acquires the stripes of the given
+	chunks, so independent chunks can be used in parallel. Using the pool as
+	a context manager acquires all stripes.
+	
+	To prevent deadlocks, stripes are always acquired in the same order. Don't
+	call lock_chunks() for more chunks while already holding some stripes,
+	unless the new chunks are a subset of the locked ones (or all stripes are held).
+	
+	set() and unload() also keep the bounding box of the chunks up to date
+	(see bounds()), and sort the chunks into buckets of bucket_size*bucket_size
+	chunks, so rectangles can be queried without looking at every chunk (see
+	chunks_inside() and chunks_outside()).
 	"""
 	
-	def __init__(self):
+	bucket_size = 16
+	
+	def __init__(self, stripes=64):
 		self._chunks = {}
-		self._lock = threading.RLock()
+		self._locks = [threading.RLock() for _ in range(stripes)]
+		
+		self._bounds = None # minx, maxx, miny, maxy, or None if there are no chunks
+		self._bounds_stale = False # set when a chunk on the border was unloaded
+		self._buckets = {} # (x, y) of bucket -> set of positions
+		self._index_lock = threading.Lock()
 	
 	def __enter__(self):
-		self._lock.acquire()
+		for lock in self._locks:
+			lock.acquire()
 		return self
 	
 	def __exit__(self, type, value, tb):
-		self._lock.release()
+		for lock in reversed(self._locks):
+			lock.release()
+	
+	@contextmanager
+	def lock_chunks(self, coords):
+		stripes = sorted({hash(pos)%len(self._locks) for pos in coords})
+		
+		for i in stripes:
+			self._locks[i].acquire()
+		try:
+			yield self
+		finally:
+			for i in reversed(stripes):
+				self._locks[i].release()
 	
 	def set(self, pos, chunk):
 		self._chunks[pos] = chunk
+		
+		with self._index_lock:
+			self._buckets.setdefault(self._bucket_of(pos), set()).add(pos)
+			
+			if self._bounds_stale:
+				pass
+			elif self._bounds:
+				minx, maxx, miny, maxy = self._bounds
+				self._bounds = (min(minx, pos.x), max(maxx, pos.x), min(miny, pos.y), max(maxy, pos.y))
+			else:
+				self._bounds = (pos.x, pos.x, pos.y, pos.y)
+	
+	def bounds(self):
+		"""
+		Returns minx, maxx, miny, maxy of the chunks, or None if there are none.
+		Only looks at all chunks if a chunk on the border was unloaded.
+		"""
+		
+		with self._index_lock:
+			if self._bounds_stale:
+				coords = list(self._chunks)
+				if coords:
+					self._bounds = (
+						min(pos.x for pos in coords), max(pos.x for pos in coords),
+						min(pos.y for pos in coords), max(pos.y for pos in coords)
+					)
+				else:
+					self._bounds = None
+				self._bounds_stale = False
+			
+			return self._bounds
+	
+	def _bucket_of(self, pos):
+		return pos.x//self.bucket_size, pos.y//self.bucket_size
+	
+	def _buckets_in(self, x, y, width, height):
+		"""
+		The buckets overlapping the rectangle, and whether they are completely inside of it.
+		Has to be called while holding the index lock.
+		"""
+		
+		size = self.bucket_size
+		xstart, ystart = x//size, y//size
+		xend, yend = (x + width - 1)//size + 1, (y + height - 1)//size + 1
+		
+		if (xend - xstart)*(yend - ystart) <= len(self._buckets):
+			keys = ((bx, by) for bx in range(xstart, xend) for by in range(ystart, yend))
+			keys = [key for key in keys if key in self._buckets]
+		else:
+			# a large rectangle and few buckets
+			keys = [(bx, by) for bx, by in self._buckets if xstart <= bx < xend and ystart <= by < yend]
+		
+		return [
+			(self._buckets[(bx, by)], x <= bx*size and (bx + 1)*size <= x + width and y <= by*size and (by + 1)*size <= y + height)
+			for bx, by in keys
+		]
+	
+	def chunks_inside(self, x, y, width, height):
+		"""
+		Returns the positions of the chunks in the rectangle.
+		"""
+		
+		if width <= 0 or height <= 0:
+			return []
+		
+		coords = []
+		with self._index_lock:
+			for bucket, inside in self._buckets_in(x, y, width, height):
+				if inside:
+					coords.extend(bucket)
+				else:
+					coords.extend(pos for pos in bucket if x <= pos.x < x + width and y <= pos.y < y + height)
+		
+		return coords
+	
+	def chunks_outside(self, x, y, width, height):
+		"""
+		Returns the positions of the chunks that are not in the rectangle.
+		Only looks at the chunks in buckets on the rectangle's border.
+		"""
+		
+		if width <= 0 or height <= 0:
+			return list(self._chunks)
+		
+		coords = []
+		with self._index_lock:
+			overlapping = {id(bucket): inside for bucket, inside in self._buckets_in(x, y, width, height)}
+			for bucket in self._buckets.values():
+				inside = overlapping.get(id(bucket))
+				if inside is None:
+					coords.extend(bucket)
+				elif not inside:
+					coords.extend(pos for pos in bucket if not (x <= pos.x < x + width and y <= pos.y < y + height))
+		
+		return coords
 	
 	def get(self, pos):
 		return self._chunks.get(pos)
@@ -202,28 +659,33 @@ class ChunkPool():
 		return chunk
 	
 	def apply_diffs(self, diffs):
-		for pos, diff in diffs.items():
-			chunk = self.get(pos) or self.create(pos)
-			#chunk = self.load(pos)
-			
-			if not diff.empty():
-				chunk.apply_diff(diff)
+		with self.lock_chunks(diffs.keys()):
+			for pos, diff in diffs.items():
+				chunk = self.get(pos) or self.create(pos)
+				#chunk = self.load(pos)
+				
+				if not diff.empty():
+					chunk.apply_diff(diff)
 	
 	def commit_diffs(self, diffs):
-		for pos, diff in diffs.items():
-			chunk = self.get(pos) or self.create(pos)
-			#chunk = self.load(pos)
-			
-			if not diff.empty():
-				chunk.commit_diff(diff)
+		with self.lock_chunks(diffs.keys()):
+			for pos, diff in diffs.items():
+				chunk = self.get(pos) or self.create(pos)
+				#chunk = self.load(pos)
+				
+				if not diff.empty():
+					chunk.commit_diff(diff)
 	
 	def commit_changes(self):
 		changes = {}
 		
-		for pos, chunk in self._chunks.items():
+		# copy, so other threads can add or remove chunks in the meantime
+		for pos, chunk in self._chunks.copy().items():
 			if chunk.modified():
-				changes[pos] = chunk.get_changes()
-				chunk.commit_changes()
+				with self.lock_chunks((pos,)):
+					if chunk.modified():
+						changes[pos] = chunk.get_changes()
+						chunk.commit_changes()
 		
 		return changes
 	
@@ -242,21 +704,44 @@ class ChunkPool():
 	def unload(self, pos):
 		if pos in self._chunks:
 			del self._chunks[pos]
+			
+			with self._index_lock:
+				key = self._bucket_of(pos)
+				bucket = self._buckets[key]
+				bucket.discard(pos)
+				if not bucket:
+					del self._buckets[key]
+				
+				if self._bounds and not self._bounds_stale:
+					minx, maxx, miny, maxy = self._bounds
+					self._bounds_stale = pos.x in (minx, maxx) or pos.y in (miny, maxy)
 	
 	def unload_list(self, coords):
 		for pos in coords:
 			self.unload(pos)
 	
-	def clean_up(self, except_for=[], condition=lambda pos, chunk: True):
+	def clean_up(self, except_for=[], condition=lambda pos, chunk: True, outside=None):
+		"""
+		Unloads the chunks not in except_for that satisfy the condition.
+		If outside is a rectangle (x, y, width, height), only the chunks
+		outside of it are considered.
+		"""
+		
 		## old list comprehension which became too long:
 		#coords = [pos for pos, chunk in self._chunks.items() if not pos in except_for and condition(chunk)]
 		
 		#self.save_changes() # needs to be accounted for by the user
 		
+		except_for = set(except_for)
 		coords = []
 		
-		for pos, chunk in self._chunks.items():
-			if not pos in except_for and condition(pos, chunk):
+		candidates = self.chunks_outside(*outside) if outside else list(self._chunks)
+		for pos in candidates:
+			chunk = self._chunks.get(pos)
+			if chunk and not pos in except_for and condition(pos, chunk):
 				coords.append(pos)
 		
-		self.unload_list(coords)
+		with self.lock_chunks(coords):
+			# the chunks might have been changed or unloaded while we weren't holding their locks
+			coords = [pos for pos in coords if pos in self._chunks and condition(pos, self._chunks[pos])]
+			self.unload_list(coords)
@@ -8,8 +8,9 @@ import time
 import websocket
 from websocket import WebSocketException as WSException
 
+import protocol
 from maps import Map, ChunkMap
-from chunks import ChunkDiff, jsonify_diffs, dejsonify_diffs
+from chunks import ChunkDiff
 from utils import Position
 from clientchunkpool import ClientChunkPool
 
@@ -18,7 +19,7 @@ class Client():
 	MOVE_FAST = 1
 	MOVE_MAP = 2
 	
-	def __init__(self, address, port=None, logfile=None):
+	def __init__(self, address, port=None, logfile=None, cachefile=None):
 		self.stopping = False
 		self.movement = self.MOVE_NORMAL
 		
@@ -29,7 +30,11 @@ class Client():
 		#self.address = f"ws://{address}:{port}/"
 		self.address = "ws://{}:{}/".format(address, port)
 		self._drawevent = threading.Event()
-		self.pool = ClientChunkPool(self)
+		self.pool = ClientChunkPool(self, cachefile)
+		
+		# features supported by both client and server, see handle_hello()
+		self.features = set()
+		self._viewport = None # last viewport sent to the server
 		
 		self.logfile = logfile
 		self.log_messages = []
@@ -46,6 +51,9 @@ class Client():
 			sys.stderr.write("Could not connect to server: {!r}\n".format(self.address))
 			return
 		
+		# until the server answers, everything is sent as JSON
+		self.send_json({"type": "hello", "data": sorted(protocol.FEATURES)})
+		
 		# create map etc.
 		sizey, sizex = stdscr.getmaxyx()
 		self.map_ = Map(sizex, sizey, self.pool, self)
@@ -70,6 +78,8 @@ class Client():
 		while not self.stopping:
 			self.update_screen()
 		
+		self.pool.close()
+		
 		if self.logfile:
 			self.save_log(self.logfile)
 	
@@ -123,9 +133,11 @@ class Client():
 			self.map_.redraw()
 		elif i == curses.KEY_F6 or i == curses.KEY_F4: # real map will later toggle on F4
 			self.chunkmap_active = not self.chunkmap_active
+			self.map_.mark_all_dirty() # the chunk map might have covered parts of the map
 			self.redraw()
 		elif i == curses.KEY_F7:
 			self.map_.alternating_colors = not self.map_.alternating_colors
+			self.map_.mark_all_dirty()
 			self.redraw()
 		elif i == curses.KEY_F10: self.map_.set_cursor(0, 0)
 		
@@ -168,16 +180,22 @@ class Client():
 			while True:
 				j = self._ws.recv()
 				if j:
-					self.handle_json(json.loads(j))
+					self.handle_message(*protocol.decode(j))
 		except (WSException, ConnectionResetError, OSError):
 			self._ws = None
 			self.stop()
 			return
 	
-	def handle_json(self, message):
-		if message["type"] == "apply-changes":
-			diffs = dejsonify_diffs(message["data"])
-			self.map_.commit_diffs(diffs)
+	def handle_message(self, mtype, data, versions):
+		if mtype == "hello":
+			self.handle_hello(data)
+		elif mtype == "apply-changes":
+			# servers without the "versions" feature don't send any
+			self.map_.commit_diffs(data, versions if "versions" in self.features else None)
+	
+	def handle_hello(self, features):
+		# servers which don't know about "hello" never answer, so we stay with JSON
+		self.features = protocol.FEATURES.intersection(features)
 	
 	def stop(self):
 		self.stopping = True
@@ -186,25 +204,46 @@ class Client():
 			self._ws = None
 		self.redraw()
 
-	def request_chunks(self, coords):
-		message = {"type": "request-chunks", "data": coords}
-		self._ws.send(json.dumps(message))
+	def request_chunks(self, coords, versions=None):
+		self.send("request-chunks", coords, versions)
 	
 	def unload_chunks(self, coords):
-		message = {"type": "unload-chunks", "data": coords}
-		self._ws.send(json.dumps(message))
+		# with a viewport, the server unloads the chunks on its own
+		if "viewport" not in self.features:
+			self.send("unload-chunks", coords)
+	
+	def set_viewport(self, x, y, width, height, preload, unload, versions=None):
+		viewport = [x, y, width, height, preload, unload]
+		if viewport != self._viewport:
+			data = list(viewport)
+			if versions and "versions" in self.features:
+				data.append([[pos[0], pos[1], version, checksum] for pos, (version, checksum) in versions.items()])
+			
+			self.send_json({"type": "viewport", "data": data})
+			self._viewport = viewport
 	
 	def send_changes(self, diffs):
-		diffs = jsonify_diffs(diffs)
-		message = {"type": "save-changes", "data": diffs}
+		self.send("save-changes", diffs)
+	
+	def send(self, mtype, data, versions=None):
+		if "versions" not in self.features:
+			versions = None
+		
+		if "binary" in self.features and protocol.binary_type(mtype):
+			self._ws.send_binary(protocol.encode_binary(mtype, data, versions))
+		else:
+			self._ws.send(protocol.encode_json(mtype, data, versions))
+	
+	def send_json(self, message):
 		self._ws.send(json.dumps(message))
 
 def main(argv):
-	if len(argv) == 1 or len(argv) > 4:
+	if len(argv) == 1 or len(argv) > 5:
 		print("Usage:")
 		#print(f"  {argv[0]} address [port [logfile]]")
-		print("  {} address [port [logfile]]".format(argv[0]))
+		print("  {} address [port [logfile [cachefile]]]".format(argv[0]))
 		print("  default port: 8000")
+		print("  cachefile: keep chunks there between runs (one per server)")
 		return
 	
 	address = argv[1]
@@ -224,9 +263,14 @@ def main(argv):
 	else:
 		logfile = None
 	
+	if len(argv) >= 5:
+		cachefile = argv[4]
+	else:
+		cachefile = None
+	
 	os.environ.setdefault('ESCDELAY', '25') # only a 25 millisecond delay
 	
-	client = Client(address, port, logfile)
+	client = Client(address, port, logfile, cachefile)
 	curses.wrapper(client.launch)
 
 if __name__ == "__main__":
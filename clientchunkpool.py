@@ -1,27 +1,126 @@
 import threading
-from chunks import ChunkPool
+from collections import OrderedDict
+from chunks import ChunkPool, Chunk
+from dbchunkpool import ChunkDB
 
 class ClientChunkPool(ChunkPool):
 	"""
 	A ChunkPool that requests/loads chunks from a client.
+	
+	The last max_unloaded chunks that were unloaded are kept around, along
+	with their versions. If a cachefile is given, older ones are saved there
+	and survive restarts. When chunks are requested, the ones kept around are
+	displayed right away, and the server only needs to send the changes since
+	their version (see protocol.py).
 	"""
 	
-	def __init__(self, client):
+	def __init__(self, client, cachefile=None):
 		super().__init__()
 		
 		self._client = client
 		self._save_thread = None
 		
 		self.save_changes_delay = .1
+		
+		self.max_unloaded = 512
+		self._unloaded = OrderedDict() # pos -> chunk, least recently unloaded first
+		self._requested = set() # requested chunks that haven't arrived yet
+		self._cache = ChunkDB(cachefile) if cachefile else None
 	
 	def set(self, pos, chunk):
 		super().set(pos, chunk)
 	
-	def commit_diffs(self, diffs):
-		super().commit_diffs(diffs)
+	def commit_diffs(self, diffs, versions=None):
+		"""
+		Changes to chunks which aren't loaded or requested are ignored
+		(e. g. changes sent before the server knew the chunk was unloaded).
+		
+		Answers to requests replace the chunk (see _replace()). Without
+		versions, the first diff for a requested chunk is the answer.
+		With versions, diffs with base version -1 replace the chunk, and the
+		others are only applied to the chunk version they are based on. Other
+		chunks are requested again, and their changes are ignored until the
+		answer arrives.
+		"""
+		
+		stale = []
+		
+		with self.lock_chunks(diffs.keys()):
+			for pos, diff in diffs.items():
+				chunk = self.get(pos)
+				requested = pos in self._requested
+				
+				if versions is None:
+					if requested:
+						self._replace(pos, diff)
+					elif chunk:
+						chunk.commit_diff(diff)
+					else:
+						continue
+				else:
+					base, version = versions[pos]
+					
+					if base == -1 and (chunk or requested):
+						self._replace(pos, diff, version)
+					elif chunk and chunk.version == base:
+						if not diff.empty():
+							chunk.commit_diff(diff)
+						chunk.version = version
+					else:
+						# the chunk is requested (again) already, and the answer contains these changes
+						if chunk and not requested:
+							stale.append(pos)
+						continue
+				
+				self._requested.discard(pos)
+			
+			self._requested.update(stale)
+		
+		if stale:
+			# without versions, so the whole chunks are sent
+			self._client.request_chunks(stale)
 		
 		self._client.redraw()
 	
+	def _replace(self, pos, diff, version=0):
+		"""
+		Replace the chunk with the content from the server. The cells not in
+		diff are blank. Modifications that haven't been sent yet are kept.
+		Has to be called while holding the chunk's lock.
+		"""
+		
+		old = self.get(pos)
+		
+		chunk = Chunk()
+		chunk.commit_diff(diff)
+		if old and old.modified():
+			chunk.apply_diff(old.get_changes())
+		chunk.version = version
+		
+		self.set(pos, chunk)
+	
+	def _restore(self, coords):
+		"""
+		Put the chunks that are kept around back into the pool until the
+		server answers. Returns their versions and checksums.
+		"""
+		
+		restored = {}
+		for pos in coords:
+			chunk = self._unloaded.pop(pos, None)
+			if chunk:
+				restored[pos] = chunk
+		
+		if self._cache:
+			restored.update(self._cache.load_many([pos for pos in coords if pos not in restored]))
+		
+		versions = {}
+		for pos, chunk in restored.items():
+			self.set(pos, chunk)
+			versions[pos] = (chunk.version, chunk.checksum())
+		
+		return versions
+	
 	def save_changes_delayed(self):
 		if not self._save_thread:
 			def threadf():
@@ -44,10 +143,66 @@ class ClientChunkPool(ChunkPool):
 	def load_list(self, coords):
 		coords = [pos for pos in coords if pos not in self._chunks]
 		if coords:
-			self._client.request_chunks(coords)
+			self._requested.update(coords)
+			versions = self._restore(coords)
+			self._client.request_chunks(coords, versions)
+	
+	def load_viewport(self, coords, viewport, preload, unload):
+		"""
+		Like load_list(), but lets the server load the chunks within preload of
+		the viewport and unload the ones further away than unload.
+		"""
+		
+		coords = [pos for pos in coords if pos not in self._chunks]
+		self._requested.update(coords)
+		versions = self._restore(coords)
+		self._client.set_viewport(*viewport, preload, unload, versions)
+	
+	def cancel_requests(self, except_for):
+		"""
+		Stop waiting for the requested chunks that aren't in except_for
+		anymore. Chunks restored from the ones kept around are unloaded again.
+		"""
+		
+		except_for = set(except_for)
+		stale = [pos for pos in self._requested if pos not in except_for]
+		
+		if stale:
+			self._requested.difference_update(stale)
+			self.unload_list(stale)
 	
 	def unload_list(self, coords):
 		if coords:
 			self._client.unload_chunks(coords)
+			self._requested.difference_update(coords)
+		
+		for pos in coords:
+			chunk = self.get(pos)
+			if chunk and not chunk.modified():
+				self._unloaded[pos] = chunk
+				self._unloaded.move_to_end(pos)
+		
+		evicted = {}
+		while len(self._unloaded) > self.max_unloaded:
+			pos, chunk = self._unloaded.popitem(last=False)
+			evicted[pos] = chunk
+		
+		if self._cache and evicted:
+			self._cache.save_many(evicted)
 		
 		super().unload_list(coords)
+	
+	def close(self):
+		"""
+		Save all unmodified chunks to the cache file.
+		"""
+		
+		if not self._cache:
+			return
+		
+		with self:
+			chunks = dict(self._unloaded)
+			chunks.update((pos, chunk) for pos, chunk in self._chunks.items() if not chunk.modified())
+			self._cache.save_many(chunks)
+		
+		self._cache.close()
@@ -0,0 +1,409 @@
+import json
+import threading
+import time
+
+import protocol
+from chunks import ChunkDiff, split_legitimate
+from dbchunkpool import DBChunkPool, recover_journals
+from metrics import metrics
+from subscriptions import SubscriptionIndex
+from utils import Position
+
+def _message_size(message):
+	"""
+	Returns the size of a websocket message in bytes, whether it is a text or
+	a binary message.
+	"""
+	
+	if isinstance(message, str):
+		return len(message.encode("utf-8", "surrogatepass"))
+	return len(message)
+
+class WotConnection():
+	"""
+	The server side of a connection to a client, independent of the websocket implementation.
+	
+	Subclasses need to provide sendMessage(), backlog() and drop() and call
+	handle_message(), connected() and disconnected(). They share the pool,
+	list of clients and subscriptions of their class (see open_world()).
+	
+	Changes made by other clients are collected per chunk and only sent every
+	flush_period seconds (see flush_all()), or once changes for flush_size
+	chunks have piled up.
+	
+	If more than max_backlog bytes are still waiting to be sent to a client,
+	changes for it are handled according to slow_client_policy:
+	  "merge":  keep collecting them per chunk until the backlog is sent
+	  "resync": forget them and send all loaded chunks again once the backlog is sent
+	  "drop":   close the connection
+	Either way, the changes queued for a slow client are bounded by its
+	loaded chunks. Answers to the client's own requests are always sent.
+	
+	How long handling each type of message takes and the bytes sent and
+	received are recorded in metrics (see the "stats" message).
+	"""
+	
+	flush_period = .05
+	flush_size = 64
+	max_viewport_chunks = 4096 # larger viewports are ignored
+	max_backlog = 1024*1024 # in bytes
+	slow_client_policy = "merge"
+	
+	def handle_hello(self, features):
+		self.features = protocol.FEATURES.intersection(features)
+		self.send_json({"type": "hello", "data": sorted(self.features)})
+	
+	def handle_request_chunks(self, coords, versions=None):
+		"""
+		versions contains the versions of the chunks the client still has,
+		so only the changes since then need to be sent (see protocol.py).
+		"""
+		
+		# Subscribing and sending while holding the locks, so no changes to
+		# the chunks can get lost or arrive before their content.
+		with self.pool.lock_chunks(coords) as pool:
+			diffs, chunk_versions = pool.read_chunks(coords, versions)
+			
+			self.loaded_chunks.update(coords)
+			self.subscriptions.subscribe(self, coords)
+			
+			self.send_chunks(diffs, chunk_versions)
+	
+	def handle_unload_chunks(self, coords):
+		coords = [pos for pos in coords if pos in self.loaded_chunks]
+		
+		self.loaded_chunks.difference_update(coords)
+		self.subscriptions.unsubscribe(self, coords)
+		
+		with self._outbound_lock:
+			for pos in coords:
+				self._outbound.pop(pos, None)
+				self._outbound_versions.pop(pos, None)
+	
+	def handle_viewport(self, viewport):
+		try:
+			x, y, width, height, preload, unload = (int(value) for value in viewport[:6])
+			known = viewport[6] if len(viewport) > 6 else []
+			versions = {Position(entry[0], entry[1]): (entry[2], entry[3]) for entry in known if len(entry) == 4}
+		except (TypeError, ValueError, KeyError, IndexError):
+			return
+		
+		unload = max(unload, preload) # or chunks would be unloaded right after loading them
+		if min(width, height, preload) < 0:
+			return
+		if (width + 2*preload)*(height + 2*preload) > self.max_viewport_chunks:
+			return
+		
+		outside = [
+			pos for pos in self.loaded_chunks
+			if not (x - unload <= pos.x < x + width + unload and y - unload <= pos.y < y + height + unload)
+		]
+		if outside:
+			self.handle_unload_chunks(outside)
+		
+		coords = [
+			Position(cx, cy)
+			for cx in range(x - preload, x + width + preload)
+			for cy in range(y - preload, y + height + preload)
+			if Position(cx, cy) not in self.loaded_chunks
+		]
+		if coords:
+			self.handle_request_chunks(coords, versions)
+	
+	def handle_save_changes(self, diffs):
+		# check whether changes are correct (exclude certain characters)
+		# apply the correct cells, and send corrections for the others back to sender
+		legitimate_diffs, illegitimate_diffs = split_legitimate(diffs)
+		if illegitimate_diffs:
+			metrics.count("illegitimate_diffs", len(illegitimate_diffs))
+		
+		if legitimate_diffs:
+			with self.pool.lock_chunks(legitimate_diffs.keys()) as pool:
+				versions = pool.write_diffs(legitimate_diffs)
+				
+				# Still holding the locks, so all clients get changes to the
+				# same chunk in the same order.
+				# Only visit the clients that have the changed chunks loaded.
+				for client, client_diffs in self.subscriptions.distribute(legitimate_diffs).items():
+					client.send_changes(client_diffs, versions)
+		
+		if illegitimate_diffs:
+			with self.pool.lock_chunks(illegitimate_diffs.keys()) as pool:
+				reverse_diffs, versions = pool.reverse_diffs(illegitimate_diffs)
+				self.send_chunks(reverse_diffs, versions)
+	
+	def handle_stats(self):
+		stats = metrics.snapshot()
+		# only the requesting client's own traffic, other clients stay anonymous
+		stats["connection"] = {
+			"bytes_in": self.bytes_in,
+			"bytes_out": self.bytes_out,
+		}
+		
+		self.send_json({"type": "stats", "data": stats})
+	
+	def send_changes(self, diffs, versions):
+		"""
+		Queue changes to be sent with the next flush.
+		versions contains the base version and version for each diff.
+		"""
+		
+		with self._outbound_lock:
+			if self._resync or self._dropped:
+				return # the client gets the chunks' current content later, or never
+			
+			for pos, diff in diffs.items():
+				# The diffs are shared between all subscribers, so they are
+				# encoded only once. They are copied before merging into them.
+				pending = self._outbound.get(pos)
+				if pending:
+					# the merged diff still starts at the first diff's base version
+					self._outbound[pos] = pending.combine(diff)
+					base = self._outbound_versions[pos][0]
+				else:
+					self._outbound[pos] = diff
+					base = versions[pos][0]
+				
+				self._outbound_versions[pos] = (base, versions[pos][1])
+			
+			if len(self._outbound) >= self.flush_size:
+				self.flush_changes()
+	
+	def send_chunks(self, diffs, versions):
+		"""
+		Send diffs right away, after all queued changes.
+		"""
+		
+		with self._outbound_lock:
+			self.flush_changes(force=True)
+			
+			if diffs:
+				self.send("apply-changes", diffs, versions)
+	
+	def flush_changes(self, force=False):
+		"""
+		Unless force is set, the changes are only sent if the client isn't
+		slow (see slow_client_policy).
+		"""
+		
+		# sending while holding the lock keeps the messages in order
+		with self._outbound_lock:
+			if not self._outbound:
+				return
+			
+			if not force and self.backlog() > self.max_backlog:
+				self.handle_slow_client()
+				return
+			
+			self.send("apply-changes", self._outbound, self._outbound_versions)
+			self._outbound = {}
+			self._outbound_versions = {}
+	
+	def handle_slow_client(self):
+		# called while holding the outbound lock
+		if self.slow_client_policy == "merge":
+			metrics.count("flushes_deferred")
+			return
+		
+		self._outbound = {}
+		self._outbound_versions = {}
+		
+		if self.slow_client_policy == "resync":
+			metrics.count("resyncs")
+			self._resync = True
+		else:
+			metrics.count("clients_dropped")
+			self._dropped = True
+			self.drop()
+	
+	def resync_pending(self):
+		return self._resync and self.backlog() <= self.max_backlog
+	
+	def resync(self):
+		"""
+		Send the current content of all loaded chunks, once the backlog is sent.
+		Must not be called while holding any locks.
+		"""
+		
+		if not self.resync_pending():
+			return
+		
+		# copying a set is atomic, but the handler might change it in the meantime
+		coords = list(self.loaded_chunks.copy())
+		
+		with self.pool.lock_chunks(coords) as pool:
+			# changes made after the chunks are read are sent as usual
+			with self._outbound_lock:
+				self._resync = False
+			
+			diffs, versions = pool.read_chunks(coords)
+			# the client's chunks might differ in any cell, so send all of them
+			diffs = {pos: ChunkDiff.from_string(diff.to_string()) for pos, diff in diffs.items()}
+			self.send_chunks(diffs, versions)
+	
+	@classmethod
+	def flush_all(cls):
+		for client in cls.clients:
+			if client:
+				client.flush_changes()
+	
+	@classmethod
+	def resync_all(cls):
+		"""
+		Resync the clients that are waiting for it. Locks their chunks and
+		might load them, so it should be called where the other pool work is done.
+		"""
+		
+		for client in cls.clients:
+			if client and client.resync_pending():
+				client.resync()
+	
+	def send(self, mtype, data, versions=None):
+		if "versions" not in self.features:
+			versions = None
+		
+		if "binary" in self.features and protocol.binary_type(mtype):
+			self.send_message(protocol.encode_binary(mtype, data, versions))
+		else:
+			self.send_message(protocol.encode_json(mtype, data, versions))
+	
+	def send_json(self, message):
+		self.send_message(json.dumps(message))
+	
+	def send_message(self, message):
+		if self._dropped:
+			return
+		
+		size = _message_size(message)
+		self.bytes_out += size
+		metrics.count("bytes_out", size)
+		
+		self.sendMessage(message)
+	
+	def handle_message(self, message):
+		size = _message_size(message)
+		self.bytes_in += size
+		metrics.count("bytes_in", size)
+		
+		start = time.perf_counter()
+		
+		mtype, data, versions = protocol.decode(message)
+		if mtype == "hello":
+			self.handle_hello(data)
+		elif mtype == "request-chunks":
+			self.handle_request_chunks(data, versions)
+		elif mtype == "unload-chunks":
+			self.handle_unload_chunks(data)
+		elif mtype == "save-changes":
+			self.handle_save_changes(data)
+		elif mtype == "viewport":
+			self.handle_viewport(data)
+		elif mtype == "stats":
+			self.handle_stats()
+		else:
+			return
+		
+		metrics.observe("handle." + mtype, time.perf_counter() - start)
+	
+	def connected(self):
+		self.loaded_chunks = set()
+		self.features = set()
+		self.bytes_in = 0
+		self.bytes_out = 0
+		
+		self._outbound = {}
+		self._outbound_versions = {} # pos -> (base version, version) of the diffs in _outbound
+		self._outbound_lock = threading.RLock()
+		self._resync = False # see resync()
+		self._dropped = False # see handle_slow_client()
+		
+		try:
+			i = self.clients.index(None)
+			self.clients[i] = self
+		except ValueError:
+			self.clients.append(self)
+			i = len(self.clients) - 1
+		
+		graphstr = "".join(["┯" if j == i else ("│" if v else " ") for j, v in enumerate(self.clients)])
+		#print(f"{graphstr}  {self.address[0]}")
+		print("{}  {}".format(graphstr, self.address[0]))
+	
+	def disconnected(self):
+		self.subscriptions.unsubscribe(self, self.loaded_chunks)
+		self.loaded_chunks = set()
+		
+		i = self.clients.index(self)
+		
+		graphstr = "".join(["┷" if j == i else ("│" if v else " ") for j, v in enumerate(self.clients)])
+		print(graphstr)
+		#print(f"{graphstr}   {self.address[0]}")
+		
+		self.clients[i] = None
+		while self.clients and not self.clients[-1]:
+			self.clients.pop()
+
+def parse_args(argv):
+	"""
+	Returns the dbfile, port and stats period, or None if the arguments are invalid.
+	"""
+	
+	if len(argv) == 1 or len(argv) > 4:
+		print("Usage:")
+		#print(f"  {argv[0]} dbfile [port]")
+		print("  {} dbfile [port [statsperiod]]".format(argv[0]))
+		print("  default port: 8000")
+		print("  statsperiod: print stats every this many seconds")
+		return
+	
+	dbfile = argv[1]
+	
+	if len(argv) >= 3:
+		try:
+			port = int(argv[2])
+		except ValueError:
+			print("Invalid port")
+			return
+	else:
+		port = 8000
+	
+	if len(argv) >= 4:
+		try:
+			stats_period = float(argv[3])
+		except ValueError:
+			print("Invalid stats period")
+			return
+	else:
+		stats_period = None
+	
+	return dbfile, port, stats_period
+
+def open_world(cls, dbfile, stats_period=None, pool=None):
+	"""
+	pool defaults to a DBChunkPool for the dbfile.
+	"""
+	
+	print("Connecting to db")
+	if not pool:
+		# including the ones of shards, see shardserver.py
+		recover_journals(dbfile)
+		pool = DBChunkPool(dbfile)
+	
+	cls.pool = pool
+	cls.clients = []
+	cls.subscriptions = SubscriptionIndex()
+	cls.pool.pinned = cls.subscriptions.subscribed # see ShardedPool.follow() for shards
+	
+	metrics.gauge("clients", lambda: sum(1 for client in cls.clients if client))
+	metrics.gauges(cls.pool.stats)
+	
+	if stats_period:
+		metrics.log_periodically(stats_period)
+
+def close_world(cls):
+	print("")
+	print("Saving recent changes.")
+	cls.pool.save_changes()
+	print("Cleaning up empty chunks from db.")
+	cls.pool.remove_empty()
+	cls.pool.close()
+	print("Stopped.")
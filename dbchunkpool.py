@@ -1,28 +1,91 @@
+import heapq
+import os
 import sqlite3
 import time
 import threading
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
-from chunks import ChunkPool, Chunk
+from chunks import ChunkPool, Chunk, ChunkDiff
+from journal import DiffJournal
+from metrics import metrics
 from utils import Position, CHUNK_WIDTH, CHUNK_HEIGHT
 
 class ChunkDB():
 	"""
 	Load and save chunks to a SQLite db.
+	
+	Each thread gets its own long-lived connection to the db, which is in WAL
+	mode, so the periodic save doesn't block chunks from being loaded.
+	
+	The encoding column says how a chunk's content is stored: Chunks with
+	few characters are stored compressed, the others as plain text. Blank
+	chunks aren't stored at all.
+	
+	The version column holds the chunk's version (see DBChunkPool).
 	"""
 	
-	def __init__(self, filename):
+	SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+	
+	ENCODING_DENSE = 0      # TEXT with one character per cell
+	ENCODING_COMPRESSED = 1 # BLOB with the zlib-compressed utf-8 of the dense text
+	
+	BLANK = " "*CHUNK_WIDTH*CHUNK_HEIGHT
+	MAX_COMPRESSED_DENSITY = .25 # ratio of non-blank cells
+	
+	def __init__(self, filename, synchronous="NORMAL", cache_size=-16000):
+		if synchronous.upper() not in self.SYNCHRONOUS_MODES:
+			raise ValueError("Invalid synchronous mode: {!r}".format(synchronous))
+		
 		self.dbfilename = filename
+		self.synchronous = synchronous.upper()
+		self.cache_size = int(cache_size) # in pages, or in KiB if negative
+		
+		self._local = threading.local()
+		self._connections = []
+		self._connections_lock = threading.Lock()
+		
+		# load_many reads the whole bounding rectangle of the requested chunks
+		# if it isn't more than this many times larger than the request
+		self.max_overfetch = 2
 		
 		self._create_table()
 	
+	def _connection(self):
+		con = getattr(self._local, "con", None)
+		
+		if con is None:
+			# The statement cache keeps the prepared statements of all queries
+			# below around, and connections are only closed via close().
+			con = sqlite3.connect(
+				self.dbfilename,
+				check_same_thread=False,
+				cached_statements=256
+			)
+			con.execute("PRAGMA journal_mode=WAL")
+			con.execute("PRAGMA synchronous={}".format(self.synchronous))
+			con.execute("PRAGMA cache_size={}".format(self.cache_size))
+			
+			self._local.con = con
+			with self._connections_lock:
+				self._connections.append(con)
+		
+		return con
+	
+	def close(self):
+		with self._connections_lock:
+			for con in self._connections:
+				con.close()
+			self._connections = []
+		
+		self._local = threading.local()
+	
 	def transaction(func):
 		def wrapper(self, *args, **kwargs):
-			con = sqlite3.connect(self.dbfilename)
-			try:
-				with con:
-					return func(self, con, *args, **kwargs)
-			finally:
-				con.close()
+			con = self._connection()
+			with con:
+				return func(self, con, *args, **kwargs)
 		
 		return wrapper
 	
@@ -33,29 +96,91 @@ class ChunkDB():
 		             "x INTEGER NOT NULL, "
 		             "y INTEGER NOT NULL, "
 		             "content TEXT, "
+		             "encoding INTEGER NOT NULL DEFAULT 0, "
+		             "version INTEGER NOT NULL DEFAULT 0, "
 		             "PRIMARY KEY (x, y)"
 		             ")"))
+		
+		# migrate dbs created before these columns existed
+		columns = {row[1] for row in cur.execute("PRAGMA table_info(chunks)")}
+		if "encoding" not in columns:
+			cur.execute("ALTER TABLE chunks ADD COLUMN encoding INTEGER NOT NULL DEFAULT 0")
+		if "version" not in columns:
+			cur.execute("ALTER TABLE chunks ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+	
+	def save_many(self, chunks):
+		self.save_list(ChunkDB.chunks_to_list(chunks))
 	
 	@transaction
-	def save_many(self, con, chunks):
-		lchunks = ChunkDB.chunks_to_list(chunks)
-		con.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?)", lchunks)
+	def save_list(self, con, lchunks):
+		blank = [(item[0], item[1]) for item in lchunks if item[2] is None]
+		stored = [item for item in lchunks if item[2] is not None]
+		
+		con.executemany("DELETE FROM chunks WHERE x=? AND y=?", blank)
+		con.executemany(("INSERT OR REPLACE INTO chunks (x, y, content, encoding, version) "
+		                 "VALUES (?, ?, ?, ?, ?)"), stored)
 	
 	@transaction
 	def load_many(self, con, coords):
-		cur = con.cursor()
-		results = []
+		coords = set(coords)
+		if not coords:
+			return {}
 		
-		for pos in coords:
-			cur.execute("SELECT * FROM chunks WHERE x=? AND y=?", pos)
-			results.extend(cur.fetchall())
+		minx = min(pos[0] for pos in coords)
+		maxx = max(pos[0] for pos in coords)
+		miny = min(pos[1] for pos in coords)
+		maxy = max(pos[1] for pos in coords)
+		area = (maxx - minx + 1)*(maxy - miny + 1)
 		
-		results = ChunkDB.list_to_chunks(results)
-		return results
+		if area <= len(coords)*self.max_overfetch:
+			# (mostly) contiguous area, like a viewport
+			cur = con.execute(("SELECT x, y, content, encoding, version FROM chunks "
+			                   "WHERE x BETWEEN ? AND ? AND y BETWEEN ? AND ?"),
+			                  (minx, maxx, miny, maxy))
+			results = [item for item in cur if (item[0], item[1]) in coords]
+		else:
+			# scattered chunks
+			con.execute(("CREATE TEMP TABLE IF NOT EXISTS wanted ("
+			             "x INTEGER NOT NULL, "
+			             "y INTEGER NOT NULL"
+			             ")"))
+			con.execute("DELETE FROM wanted")
+			con.executemany("INSERT INTO wanted VALUES (?, ?)", coords)
+			cur = con.execute(("SELECT chunks.x, chunks.y, chunks.content, chunks.encoding, chunks.version "
+			                   "FROM wanted JOIN chunks "
+			                   "ON chunks.x = wanted.x AND chunks.y = wanted.y"))
+			results = cur.fetchall()
+		
+		return ChunkDB.list_to_chunks(results)
 	
 	@transaction
 	def remove_empty(self, con):
-		con.execute("DELETE FROM chunks WHERE content=?", (" "*CHUNK_WIDTH*CHUNK_HEIGHT,))
+		# blank chunks aren't saved anymore, but older dbs might still contain some
+		con.execute("DELETE FROM chunks WHERE encoding=? AND content=?", (ChunkDB.ENCODING_DENSE, ChunkDB.BLANK))
+	
+	@staticmethod
+	def encode_content(s):
+		"""
+		Returns the content and encoding to store a chunk string with.
+		The content is None if the chunk is blank.
+		"""
+		
+		blanks = s.count(" ")
+		if blanks == len(s):
+			return None, ChunkDB.ENCODING_DENSE
+		elif len(s) - blanks <= len(s)*ChunkDB.MAX_COMPRESSED_DENSITY:
+			return zlib.compress(s.encode("utf-8", "surrogatepass")), ChunkDB.ENCODING_COMPRESSED
+		else:
+			return s, ChunkDB.ENCODING_DENSE
+	
+	@staticmethod
+	def decode_content(content, encoding):
+		if encoding == ChunkDB.ENCODING_DENSE:
+			return content
+		elif encoding == ChunkDB.ENCODING_COMPRESSED:
+			return zlib.decompress(content).decode("utf-8", "surrogatepass")
+		else:
+			raise ValueError("Unknown chunk encoding: {!r}".format(encoding))
 	
 	@staticmethod
 	def list_to_chunks(l):
@@ -63,7 +188,8 @@ class ChunkDB():
 		
 		for item in l:
 			pos = Position(item[0], item[1])
-			chunk = Chunk.from_string(item[2])
+			chunk = Chunk.from_string(ChunkDB.decode_content(item[2], item[3]))
+			chunk.version = item[4]
 			chunks[pos] = chunk
 		
 		return chunks
@@ -73,21 +199,70 @@ class ChunkDB():
 		l = []
 		
 		for pos, chunk in chunks.items():
-			l.append((pos[0], pos[1], chunk.to_string()))
+			content, encoding = ChunkDB.encode_content(chunk.to_string())
+			l.append((pos[0], pos[1], content, encoding, chunk.version))
 		
 		return l
 
 class DBChunkPool(ChunkPool):
 	"""
 	A ChunkPool that can load/save chunks from/to a database.
+	
+	Applied diffs are also written to a journal, so changes that haven't
+	been saved yet can be recovered after a crash.
+	
+	If max_chunks is set, the least recently used chunks are unloaded as soon
+	as more chunks are loaded. Chunks that are pinned (see pinned()), modified
+	or whose changes aren't in the db yet are never unloaded this way.
+	Since chunks have a fixed size, max_chunks also limits their memory.
+	
+	Chunks that haven't been modified for max_age seconds are unloaded by the
+	periodic save, unless they are pinned, modified or not saved yet. Each
+	chunk is scheduled in a heap when it's loaded, so only the chunks that
+	are due are looked at (see expire()).
+	
+	Each change to a chunk increases its version. The last history_length
+	changes of each loaded chunk are kept, so a client that has an older
+	version of a chunk only needs to get the changes since then (see
+	changes_since()).
+	
+	How long lock_chunks() waits for and holds the locks, and how long the db
+	takes to load and save chunks is recorded in metrics.
 	"""
 	
-	def __init__(self, filename):
+	def __init__(self, filename, journal=True, max_chunks=None, journal_name=None):
 		super().__init__()
 		self._chunkdb = ChunkDB(filename)
+		self._journal = DiffJournal(journal_name or filename) if journal else None
+		self._closed = False
 		
 		self.save_period = 60 # save and clean up every minute
 		self.max_age = 60 # ca. one minute until a chunk is unloaded again
+		self.max_chunks = max_chunks
+		self.history_length = 8
+		
+		# pos -> deque of (version, diff, checksum) for the last changes,
+		# starting with the version before the first of them (without a diff)
+		self._history = {}
+		
+		self._lru = OrderedDict() # positions of all chunks, least recently used first
+		self._lru_lock = threading.Lock()
+		# heap of (deadline, pos) for expire(), and the current deadline of each chunk
+		self._expiry = []
+		self._deadlines = {}
+		self._expiry_lock = threading.Lock()
+		# chunks modified before this point in time have been saved to the db
+		self._saved_until = time.time()
+		
+		# several threads load, evict and expire chunks at the same time
+		self._counters_lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+		
+		if self._journal:
+			self._replay_journal()
 		
 		self.save_thread = threading.Thread(
 			target=self.perodic_save,
@@ -96,54 +271,376 @@ class DBChunkPool(ChunkPool):
 		)
 		self.save_thread.start()
 	
+	def _replay_journal(self):
+		for segment in self._journal.segments():
+			for diffs in self._journal.read(segment):
+				self.load_list(diffs.keys())
+				self._apply_diffs(diffs)
+		
+		# also removes the replayed segments
+		self.save_changes()
+	
+	def apply_diffs(self, diffs):
+		if not self._journal:
+			with self.lock_chunks(diffs.keys()):
+				self._apply_diffs(diffs)
+			return
+		
+		# Appending and applying happen together, so that all diffs in the
+		# segments returned by rotate() have been applied to the pool.
+		# The chunks are locked before the journal to prevent deadlocks.
+		with self.lock_chunks(diffs.keys()):
+			with self._journal.lock:
+				self._journal.append(diffs)
+				self._apply_diffs(diffs)
+	
+	def _apply_diffs(self, diffs):
+		"""
+		Apply diffs and increase the version of the changed chunks.
+		Replaying the journal does this too, so versions survive a crash.
+		"""
+		
+		for pos, diff in diffs.items():
+			chunk = self.get(pos) or self.create(pos)
+			if diff.empty():
+				continue
+			
+			history = self._history.get(pos)
+			if history is None:
+				history = deque([(chunk.version, None, chunk.checksum())], maxlen=self.history_length)
+				self._history[pos] = history
+			
+			chunk.apply_diff(diff)
+			chunk.version += 1
+			history.append((chunk.version, diff, chunk.checksum()))
+	
+	def changes_since(self, pos, version, checksum):
+		"""
+		Returns the changes to a loaded chunk since the given version as a
+		single diff, or None if that version isn't known (anymore).
+		Meant to be called while holding the chunk's lock.
+		"""
+		
+		chunk = self.get(pos)
+		if chunk.version == version:
+			return ChunkDiff() if chunk.checksum() == checksum else None
+		
+		changes = None
+		for entry_version, diff, entry_checksum in self._history.get(pos, ()):
+			if changes is not None:
+				changes.apply(diff)
+			elif entry_version == version and entry_checksum == checksum:
+				changes = ChunkDiff()
+		
+		return changes
+	
+	@contextmanager
+	def lock_chunks(self, coords):
+		start = time.perf_counter()
+		with super().lock_chunks(coords):
+			acquired = time.perf_counter()
+			metrics.observe("pool.lock_wait", acquired - start)
+			try:
+				yield self
+			finally:
+				metrics.observe("pool.lock_hold", time.perf_counter() - acquired)
+	
+	def modified_count(self):
+		return sum(1 for chunk in self._chunks.copy().values() if chunk.modified())
+	
+	def read_chunks(self, coords, versions=None):
+		"""
+		Returns a diff for each of the chunks and their base versions and
+		versions (see protocol.py). If versions contains a version of a chunk
+		that is still known, the diff only contains the changes since then.
+		"""
+		
+		diffs = {}
+		chunk_versions = {}
+		
+		with self.lock_chunks(coords):
+			self.load_list(coords)
+			
+			for pos in coords:
+				chunk = self.get(pos)
+				
+				known = versions.get(pos) if versions else None
+				changes = self.changes_since(pos, *known) if known else None
+				if changes is None:
+					diffs[pos] = chunk.as_diff()
+					chunk_versions[pos] = (-1, chunk.version)
+				else:
+					diffs[pos] = changes
+					chunk_versions[pos] = (known[0], chunk.version)
+					metrics.count("chunks_revalidated")
+		
+		return diffs, chunk_versions
+	
+	def write_diffs(self, diffs):
+		"""
+		Load the chunks and apply the diffs to them.
+		Returns the base versions and versions of the diffs.
+		"""
+		
+		with self.lock_chunks(diffs.keys()):
+			self.load_list(diffs.keys())
+			self.apply_diffs(diffs)
+			
+			versions = {}
+			for pos, diff in diffs.items():
+				version = self.get(pos).version
+				versions[pos] = (version if diff.empty() else version - 1, version)
+		
+		return versions
+	
+	def reverse_diffs(self, diffs):
+		"""
+		Returns diffs that undo the diffs on the current chunks, and their
+		versions. The chunks themselves aren't changed.
+		"""
+		
+		with self.lock_chunks(diffs.keys()):
+			self.load_list(diffs.keys())
+			
+			reverse_diffs = {}
+			versions = {}
+			for pos, diff in diffs.items():
+				chunk = self.get(pos)
+				reverse_diffs[pos] = diff.diff(chunk.as_diff())
+				versions[pos] = (chunk.version, chunk.version)
+		
+		return reverse_diffs, versions
+	
+	def stats(self):
+		with self._counters_lock:
+			counters = {
+				"pool_hits": self.hits,
+				"pool_misses": self.misses,
+				"pool_evictions": self.evictions,
+				"pool_expirations": self.expirations,
+			}
+		
+		return {
+			"chunks": len(self._chunks),
+			"chunks_modified": self.modified_count(),
+			**counters,
+		}
+	
+	def pinned(self, pos):
+		"""
+		Whether a chunk must stay loaded, e. g. because a client is displaying it.
+		Meant to be replaced by the user.
+		"""
+		
+		return False
+	
+	def set(self, pos, chunk):
+		super().set(pos, chunk)
+		
+		with self._lru_lock:
+			self._lru[pos] = None
+			self._lru.move_to_end(pos)
+		
+		with self._expiry_lock:
+			if pos not in self._deadlines:
+				# chunks loaded from the db weren't modified recently, but were just used
+				self._schedule(pos, max(chunk.last_modified, time.time()) + self.max_age)
+	
+	def get(self, pos):
+		chunk = super().get(pos)
+		
+		if chunk:
+			with self._lru_lock:
+				if pos in self._lru:
+					self._lru.move_to_end(pos)
+		
+		return chunk
+	
+	def unload(self, pos):
+		super().unload(pos)
+		self._history.pop(pos, None)
+		
+		with self._lru_lock:
+			self._lru.pop(pos, None)
+		
+		with self._expiry_lock:
+			self._deadlines.pop(pos, None)
+	
+	def _schedule(self, pos, deadline):
+		"""
+		Has to be called while holding the expiry lock.
+		Older heap entries for the chunk are ignored from now on.
+		"""
+		
+		self._deadlines[pos] = deadline
+		heapq.heappush(self._expiry, (deadline, pos))
+	
+	def expire(self, now=None):
+		"""
+		Unload the chunks that haven't been modified for max_age seconds.
+		
+		Only the chunks whose deadline has passed are looked at. Chunks that
+		were modified since they were scheduled get a new deadline, and so do
+		chunks that can't be unloaded yet (see _evictable()).
+		"""
+		
+		now = now or time.time()
+		
+		due = []
+		with self._expiry_lock:
+			while self._expiry and self._expiry[0][0] <= now:
+				deadline, pos = heapq.heappop(self._expiry)
+				if self._deadlines.get(pos) == deadline:
+					del self._deadlines[pos]
+					due.append(pos)
+		
+		if not due:
+			return
+		
+		saved_until = self._saved_until
+		with self.lock_chunks(due):
+			expired = []
+			with self._expiry_lock:
+				for pos in due:
+					chunk = self._chunks.get(pos)
+					if not chunk or pos in self._deadlines:
+						continue # unloaded or loaded again in the meantime
+					
+					deadline = chunk.last_modified + self.max_age
+					if deadline > now:
+						self._schedule(pos, deadline)
+					elif not self._evictable(pos, chunk, saved_until):
+						self._schedule(pos, now + self.max_age)
+					else:
+						expired.append(pos)
+			
+			self.unload_list(expired)
+		
+		with self._counters_lock:
+			self.expirations += len(expired)
+	
+	def _evictable(self, pos, chunk, saved_until):
+		return (
+			not chunk.modified()
+			and chunk.last_modified < saved_until
+			and not self.pinned(pos)
+		)
+	
+	def _evict(self, keep=()):
+		"""
+		Unload least recently used chunks until there are at most max_chunks left.
+		The chunks in keep are not unloaded.
+		"""
+		
+		if self.max_chunks is None:
+			return
+		
+		victims = []
+		skipped = []
+		saved_until = self._saved_until
+		
+		with self._lru_lock:
+			excess = len(self._lru) - self.max_chunks
+			
+			for pos in self._lru:
+				if len(victims) >= excess:
+					break
+				
+				if pos in keep:
+					continue
+				
+				# Never wait for a chunk's lock while holding other locks.
+				# A chunk that's locked is in use anyways.
+				lock = self._locks[hash(pos)%len(self._locks)]
+				if not lock.acquire(blocking=False):
+					continue
+				
+				chunk = self._chunks.get(pos)
+				if chunk and self._evictable(pos, chunk, saved_until):
+					victims.append((pos, lock))
+				else:
+					skipped.append(pos)
+					lock.release()
+			
+			# don't look at the skipped chunks again next time
+			for pos in skipped:
+				self._lru.move_to_end(pos)
+		
+		for pos, lock in victims:
+			self.unload(pos)
+			lock.release()
+		
+		with self._counters_lock:
+			self.evictions += len(victims)
+	
 	def save_changes(self):
+		if self._journal:
+			old_segments = self._journal.rotate()
+		
+		# commit_changes() touches the chunks, so all changes made before now are saved below
+		save_start = time.time()
 		diffs = self.commit_changes()
 		
-		changed_chunks = {}
-		for pos, diff in diffs.items():
-			chunk = self.get(pos)
-			changed_chunks[pos] = chunk
+		# only hold the locks while taking a snapshot, not while writing to the db
+		with self.lock_chunks(diffs.keys()):
+			changed_chunks = {}
+			for pos, diff in diffs.items():
+				chunk = self.get(pos)
+				changed_chunks[pos] = chunk
+			
+			lchunks = ChunkDB.chunks_to_list(changed_chunks)
+		
+		with metrics.timed("db.save_many"):
+			self._chunkdb.save_list(lchunks)
+		self._saved_until = save_start
 		
-		self._chunkdb.save_many(changed_chunks)
+		if self._journal:
+			self._journal.remove(old_segments)
 	
 	def load(self, pos):
 		raise Exception
 	
 	def load_list(self, coords):
-		to_load = [pos for pos in coords if pos not in self._chunks]
-		chunks = self._chunkdb.load_many(to_load)
-		
-		for pos in to_load:
-			if pos in chunks:
-				self.set(pos, chunks.get(pos))
+		with self.lock_chunks(coords):
+			to_load = [pos for pos in coords if pos not in self._chunks]
+			if to_load:
+				with metrics.timed("db.load_many"):
+					chunks = self._chunkdb.load_many(to_load)
 			else:
-				self.create(pos)
+				chunks = {}
+			
+			for pos in to_load:
+				if pos in chunks:
+					self.set(pos, chunks.get(pos))
+				else:
+					self.create(pos)
+			
+			with self._counters_lock:
+				self.hits += len(coords) - len(to_load)
+				self.misses += len(to_load)
+			
+			self._evict(keep=set(coords))
 	
 	def perodic_save(self):
+		# save_changes() and expire() only lock the chunks they work on
 		while True:
 			time.sleep(self.save_period)
+			if self._closed:
+				return
 			
-			with self:
-				self.save_changes()
-				
-				# unload old chunks
-				now = time.time()
-				self.clean_up(condition=lambda pos, chunk: chunk.age(now) > self.max_age)
+			self.save_changes()
+			
+			# unload old chunks
+			self.expire()
 	
 	def remove_empty(self):
 		self._chunkdb.remove_empty()
 	
-	def _get_min_max(self):
-		"""
-		Meant for debugging.
-		"""
-		
-		minx = min(pos.x for pos in self._chunks)
-		maxx = max(pos.x for pos in self._chunks)
-		miny = min(pos.y for pos in self._chunks)
-		maxy = max(pos.y for pos in self._chunks)
-		
-		return minx, maxx, miny, maxy
+	def close(self):
+		self._closed = True
+		if self._journal:
+			self._journal.close()
+		self._chunkdb.close()
 	
 	def _print_chunks(self):
 		"""
@@ -151,7 +648,7 @@ class DBChunkPool(ChunkPool):
 		"""
 		
 		if self._chunks:
-			minx, maxx, miny, maxy = self._get_min_max()
+			minx, maxx, miny, maxy = self.bounds()
 			sizex, sizey = maxx - minx + 1, maxy - miny + 1
 			print("┌" + "─"*sizex*2 + "┐")
 			for y in range(miny, maxy + 1):
@@ -168,3 +665,47 @@ class DBChunkPool(ChunkPool):
 				line = "".join(line)
 				print("│" + line + "│")
 			print("└" + "─"*sizex*2 + "┘")
+
+def shard_journal_name(dbfile, index):
+	"""
+	The journal of a shard of shardserver.py serving the db.
+	"""
+	
+	return "{}-shard{}".format(dbfile, index)
+
+def journal_names(dbfile):
+	"""
+	Returns the names of all journals of the db that have segments on disk:
+	The one of an unsharded server, and the ones of any number of shards.
+	"""
+	
+	directory, name = os.path.split(dbfile)
+	names = set()
+	
+	for filename in os.listdir(directory or "."):
+		# see DiffJournal._filename()
+		base, _, segment = filename.rpartition("-edits.")
+		if not segment.isdigit():
+			continue
+		
+		if base == name:
+			names.add(dbfile)
+		elif base.startswith(name + "-shard") and base[len(name + "-shard"):].isdigit():
+			names.add(shard_journal_name(dbfile, int(base[len(name + "-shard"):])))
+	
+	return sorted(names)
+
+def recover_journals(dbfile):
+	"""
+	Replay all journals of the db into it and remove them, no matter whether
+	they were written by an unsharded server or by shards. Has to be called
+	before the db is served, so changes from a crash in one mode are neither
+	missing in the other one, nor replayed over newer changes later.
+	
+	Since this happens on every start, all journals left are from the same
+	run, and chunks are only ever changed through one of its journals.
+	"""
+	
+	for name in journal_names(dbfile):
+		# replays the journal on creation and removes it on close
+		DBChunkPool(dbfile, journal_name=name).close()
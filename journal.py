@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+
+from chunks import jsonify_diffs, dejsonify_diffs
+
+class DiffJournal():
+	"""
+	An append-only log of the diffs applied to a DBChunkPool, so they survive a crash.
+	
+	Appended diffs are written to the journal file immediately, and fsynced
+	in groups every sync_period seconds by a background thread.
+	
+	The journal is split into numbered segments. When the pool saves its
+	changes, it starts a new segment with rotate() and removes the older
+	segments once the changes have reached the db. Segments that still exist
+	on startup belong to changes that never reached the db and need to be
+	replayed.
+	"""
+	
+	def __init__(self, basename, sync_period=.05):
+		self.basename = basename
+		self.sync_period = sync_period
+		
+		# held while appending, together with applying the diffs to the pool
+		self.lock = threading.RLock()
+		self._sync_lock = threading.Lock()
+		
+		self._segment = max(self.segments(), default=0) + 1
+		self._file = open(self._filename(self._segment), "a", encoding="utf-8")
+		self._unsynced = False
+		
+		self.sync_thread = threading.Thread(
+			target=self.periodic_sync,
+			name="sync_thread",
+			daemon=True
+		)
+		self.sync_thread.start()
+	
+	def _filename(self, segment):
+		return "{}-edits.{}".format(self.basename, segment)
+	
+	def segments(self):
+		"""
+		Returns the numbers of all segments on disk, oldest first.
+		"""
+		
+		directory, prefix = os.path.split(self._filename(""))
+		segments = []
+		
+		for name in os.listdir(directory or "."):
+			if name.startswith(prefix) and name[len(prefix):].isdigit():
+				segments.append(int(name[len(prefix):]))
+		
+		return sorted(segments)
+	
+	def read(self, segment):
+		"""
+		Yields the diffs in a segment, in the order they were appended.
+		"""
+		
+		# binary, so a cut off UTF-8 sequence fails in json.loads() like any other cut off line
+		with open(self._filename(segment), "rb") as f:
+			for line in f:
+				try:
+					ddiffs = json.loads(line)
+				except ValueError:
+					return # the last line might have been cut off by a crash
+				
+				yield dejsonify_diffs(ddiffs)
+	
+	def append(self, diffs):
+		with self.lock:
+			self._file.write(json.dumps(jsonify_diffs(diffs)) + "\n")
+			self._file.flush()
+			self._unsynced = True
+	
+	def rotate(self):
+		"""
+		Starts a new segment and returns the numbers of all older ones.
+		"""
+		
+		with self.lock:
+			with self._sync_lock:
+				self._close_file()
+				self._segment += 1
+				self._file = open(self._filename(self._segment), "a", encoding="utf-8")
+			
+			return [segment for segment in self.segments() if segment < self._segment]
+	
+	def remove(self, segments):
+		for segment in segments:
+			os.remove(self._filename(segment))
+	
+	def _close_file(self):
+		self._file.flush()
+		os.fsync(self._file.fileno())
+		self._file.close()
+		self._unsynced = False
+	
+	def sync(self):
+		with self.lock:
+			if not self._unsynced:
+				return
+			
+			f = self._file
+			f.flush()
+			self._unsynced = False
+		
+		# don't block appends while waiting for the disk
+		with self._sync_lock:
+			if not f.closed: # otherwise, it was synced when it was closed
+				os.fsync(f.fileno())
+	
+	def periodic_sync(self):
+		while not self._file.closed:
+			time.sleep(self.sync_period)
+			self.sync()
+	
+	def close(self):
+		with self.lock:
+			with self._sync_lock:
+				self._close_file()
+			
+			if not os.path.getsize(self._filename(self._segment)):
+				self.remove([self._segment])
@@ -2,6 +2,7 @@ from collections import namedtuple
 import curses
 import math
 import threading
+import time
 from utils import CHUNK_HEIGHT, CHUNK_WIDTH, chunkx, chunky, inchunkx, inchunky, Position
 
 class Map():
@@ -15,6 +16,9 @@ class Map():
 		
 		self.chunkpreload = 1 # preload chunks in this radius (they will count as "visible")
 		self.chunkunload = 10 # don't unload chunks within this radius
+		self.prefetch_time = .5 # load the chunks the map will reach within this many seconds
+		self.prefetch_budget = 32 # but at most this many chunks more than usual
+		self.prefetch_timeout = .3 # moves further apart than this don't count as one movement
 		self.cursorpadding = 2
 		self.cursorx = 0
 		self.cursory = 0
@@ -23,11 +27,21 @@ class Map():
 		self.worldx = -width//3
 		self.worldy = -height//3
 		
+		self._visible = None # viewport, chunkpreload and set of the visible chunks, see visible_chunk_set()
+		self._velocity = (0, 0) # of the map, in characters per second
+		self._last_move = None # time, worldx and worldy of the last move
+		
 		self.chunkpool = chunkpool
 		self.client = client
 		
 		self.alternating_colors = False
 		
+		# chunks that need to be drawn to the pad again, see draw()
+		self._dirty = set()
+		self._dirty_all = True
+		self._dirty_lock = threading.Lock()
+		self._drawn_origin = None
+		
 		self._pad = curses.newpad(1, 1) # size doesn't matter (heh), since it resizes
 		self.resize(width, height)      # directly afterwards to fit the width+height
 		
@@ -43,15 +57,43 @@ class Map():
 		self._lock.release()
 	
 	def redraw(self):
+		self.mark_all_dirty()
 		self._pad.redrawwin()
 		
 		self.client.redraw()
 	
+	def mark_dirty(self, coords):
+		with self._dirty_lock:
+			self._dirty.update(coords)
+	
+	def mark_all_dirty(self):
+		with self._dirty_lock:
+			self._dirty_all = True
+	
 	def draw(self):
+		"""
+		Only draws the chunks that changed since the last draw to the pad,
+		unless the pad has been scrolled by a whole chunk or everything was marked dirty.
+		"""
+		
+		originx, originy = chunkx(self.worldx), chunky(self.worldy)
+		
+		with self._dirty_lock:
+			dirty, self._dirty = self._dirty, set()
+			draw_all = self._dirty_all or self._drawn_origin != (originx, originy)
+			self._dirty_all = False
+			self._drawn_origin = (originx, originy)
+		
+		if draw_all:
+			self._pad.touchwin()
+		
 		with self.chunkpool as pool:
 			for x in range(chunkx(self.width) + 2):      # +2, not +1, or there will be empty gaps
 				for y in range(chunky(self.height) + 2): # in the bottom and right borders
-					pos = Position(x+chunkx(self.worldx), y+chunky(self.worldy))
+					pos = Position(x+originx, y+originy)
+					if not draw_all and pos not in dirty:
+						continue
+					
 					chunk = pool.get(pos)
 					if chunk:
 						self.draw_chunk_to(x*CHUNK_WIDTH, y*CHUNK_HEIGHT, chunk, (pos.x+pos.y)%2)
@@ -90,25 +132,87 @@ class Map():
 				y += 1
 	
 	def _unload_condition(self, pos, chunk):
-		xstart = chunkx(self.worldx) - self.chunkunload
-		ystart = chunky(self.worldy) - self.chunkunload
-		xend = xstart + chunkx(self.width)+2 + 2*self.chunkunload
-		yend = ystart + chunky(self.height)+2 + 2*self.chunkunload
+		xstart, ystart, width, height = self.unload_rect()
+		xend = xstart + width
+		yend = ystart + height
 		
 		in_range = pos.x >= xstart and pos.x < xend and pos.y >= ystart and pos.y < yend
 		return not in_range and not chunk.modified()
 	
+	def unload_rect(self):
+		"""
+		Unmodified chunks outside of this rectangle are unloaded.
+		"""
+		
+		x, y, width, height = self.viewport()
+		return x - self.chunkunload, y - self.chunkunload, width + 2*self.chunkunload, height + 2*self.chunkunload
+	
+	def viewport(self):
+		"""
+		The chunks on the screen as x, y, width and height, in chunks.
+		"""
+		
+		return chunkx(self.worldx), chunky(self.worldy), chunkx(self.width)+2, chunky(self.height)+2
+	
+	def prefetch_viewport(self):
+		"""
+		The viewport, extended in the direction the map is moving, so the
+		chunks it is moving towards are loaded before they become visible.
+		"""
+		
+		x, y, width, height = self.viewport()
+		vx, vy = self._velocity
+		
+		dx = vx*self.prefetch_time/CHUNK_WIDTH
+		dy = vy*self.prefetch_time/CHUNK_HEIGHT
+		
+		# every chunk of lookahead in x costs a column of chunks, in y a row
+		cost = abs(dx)*(height + 2*self.chunkpreload) + abs(dy)*(width + 2*self.chunkpreload)
+		if cost > self.prefetch_budget:
+			dx *= self.prefetch_budget/cost
+			dy *= self.prefetch_budget/cost
+		
+		dx, dy = int(dx), int(dy)
+		return x + min(dx, 0), y + min(dy, 0), width + abs(dx), height + abs(dy)
+	
+	def _track_velocity(self):
+		now = time.time()
+		
+		if self._last_move and now - self._last_move[0] <= self.prefetch_timeout:
+			then, worldx, worldy = self._last_move
+			dt = max(now - then, .01) # key repeat may deliver several moves at once
+			vx, vy = self._velocity
+			# smooth it, so a single short move doesn't change the direction right away
+			self._velocity = (
+				(vx + (self.worldx - worldx)/dt)/2,
+				(vy + (self.worldy - worldy)/dt)/2
+			)
+		else:
+			self._velocity = (0, 0)
+		
+		self._last_move = (now, self.worldx, self.worldy)
+	
 	def load_visible(self):
 		with self.chunkpool as pool:
-			coords = self.visible_chunk_coords()
-			pool.load_list(coords)
-			pool.clean_up(except_for=coords, condition=self._unload_condition)
+			viewport = self.prefetch_viewport()
+			coords = self.visible_chunk_coords(viewport)
+			
+			if "viewport" in self.client.features:
+				# the server sends the chunks within chunkpreload and unloads the others
+				pool.load_viewport(coords, viewport, self.chunkpreload, self.chunkunload)
+			else:
+				pool.load_list(coords)
+				# e. g. prefetched chunks the map isn't moving towards anymore
+				pool.cancel_requests(except_for=coords)
+			
+			pool.clean_up(except_for=coords, condition=self._unload_condition, outside=self.unload_rect())
 		
 		self.client.redraw()
 	
 	def resize(self, width, height):
 		self.width = width
 		self.height = height
+		self.mark_all_dirty()
 		
 		self._pad.resize(
 			(chunky(height) + 2)*CHUNK_HEIGHT,
@@ -117,13 +221,14 @@ class Map():
 		
 		self.load_visible()
 	
-	def visible_chunk_coords(self):
+	def visible_chunk_coords(self, viewport=None):
 		coords = []
 		
-		xstart = chunkx(self.worldx) - self.chunkpreload
-		ystart = chunky(self.worldy) - self.chunkpreload
-		xend = xstart + chunkx(self.width)+2 + 2*self.chunkpreload
-		yend = ystart + chunky(self.height)+2 + 2*self.chunkpreload
+		x, y, width, height = viewport or self.viewport()
+		xstart = x - self.chunkpreload
+		ystart = y - self.chunkpreload
+		xend = xstart + width + 2*self.chunkpreload
+		yend = ystart + height + 2*self.chunkpreload
 		
 		for x in range(xstart, xend):
 			for y in range(ystart, yend):
@@ -131,23 +236,39 @@ class Map():
 		
 		return coords
 	
+	def visible_chunk_set(self):
+		"""
+		The visible_chunk_coords() as a set, which is only computed again
+		once the viewport changed.
+		"""
+		
+		key = (self.viewport(), self.chunkpreload)
+		if not self._visible or self._visible[0] != key:
+			self._visible = (key, frozenset(self.visible_chunk_coords()))
+		
+		return self._visible[1]
+	
 	def write(self, char):
 		with self.chunkpool as pool:
-			chunk = pool.get(Position(chunkx(self.cursorx), chunky(self.cursory)))
+			pos = Position(chunkx(self.cursorx), chunky(self.cursory))
+			chunk = pool.get(pos)
 			
 			if chunk:
 				chunk.set(inchunkx(self.cursorx), inchunky(self.cursory), char)
 				pool.save_changes_delayed()
+				self.mark_dirty((pos,))
 				
 				self.move_cursor(1, 0, False)
 	
 	def delete(self):
 		with self.chunkpool as pool:
-			chunk = pool.get(Position(chunkx(self.cursorx-1), chunky(self.cursory)))
+			pos = Position(chunkx(self.cursorx-1), chunky(self.cursory))
+			chunk = pool.get(pos)
 			
 			if chunk:
 				chunk.delete(inchunkx(self.cursorx-1), inchunky(self.cursory))
 				pool.save_changes_delayed()
+				self.mark_dirty((pos,))
 				
 				self.move_cursor(-1, 0, False)
 	
@@ -178,6 +299,7 @@ class Map():
 			)
 		)
 		
+		self._track_velocity()
 		self.load_visible()
 		
 	
@@ -211,9 +333,12 @@ class Map():
 		
 		#self.load_visible()
 	
-	def commit_diffs(self, diffs):
+	def commit_diffs(self, diffs, versions=None):
 		with self.chunkpool as pool:
-			pool.commit_diffs(diffs)
+			pool.commit_diffs(diffs, versions)
+		
+		self.mark_dirty(diffs.keys())
+		self.client.redraw()
 
 ChunkStyle = namedtuple("ChunkStyle", "string color")
 
@@ -237,6 +362,7 @@ class ChunkMap():
 		#minx, maxx, miny, maxy = self.get_min_max()
 		#self.win = curses.newwin(maxy-miny+2, maxx-minx+2)
 		self.win = curses.newwin(2, 2)
+		self._drawn = None # bounds and styles of the chunks, as last drawn to the window
 		
 		if curses.has_colors():
 			curses.init_pair(3, curses.COLOR_BLACK, curses.COLOR_BLUE) # empty chunk
@@ -251,46 +377,52 @@ class ChunkMap():
 			self.win.resize(sizey + 3, 2*sizex + 4)
 	
 	def draw(self):
+		"""
+		Only draws the window again if a chunk's style or the bounds changed.
+		The map is drawn before and covers it, so it is always put back on top.
+		"""
+		
 		with self.chunkpool as pool:
-			if pool._chunks:
-				minx, maxx, miny, maxy = self.get_min_max(pool)
-			else:
-				minx, maxx, miny, maxy = 0, 0, 0, 0
-			sizex = maxx - minx
-			sizey = maxy - miny
-			self.update_size(sizex, sizey)
-			
-			self.win.erase()
-			self.win.border()
-			
-			for pos, chunk in pool._chunks.items():
-				style = self.style_of(pos, chunk)
-				if curses.has_colors():
-					self.win.addstr(
-						pos.y - miny + 1,
-						2*(pos.x - minx) + 1,
-						"  ",
-						curses.color_pair(style.color)
-					)
-				else:
-					self.win.addstr(
-						pos.y - miny + 1,
-						2*(pos.x - minx) + 1,
-						style.string
-					)
-			
+			bounds = self.get_min_max(pool)
+			styles = {pos: self.style_of(pos, chunk) for pos, chunk in pool._chunks.items()}
+		
+		if self._drawn == (bounds, styles):
+			self.win.touchwin()
 			self.win.noutrefresh()
+			return
+		
+		self._drawn = (bounds, styles)
+		
+		minx, maxx, miny, maxy = bounds
+		sizex = maxx - minx
+		sizey = maxy - miny
+		self.update_size(sizex, sizey)
+		
+		self.win.erase()
+		self.win.border()
+		
+		for pos, style in styles.items():
+			if curses.has_colors():
+				self.win.addstr(
+					pos.y - miny + 1,
+					2*(pos.x - minx) + 1,
+					"  ",
+					curses.color_pair(style.color)
+				)
+			else:
+				self.win.addstr(
+					pos.y - miny + 1,
+					2*(pos.x - minx) + 1,
+					style.string
+				)
+		
+		self.win.noutrefresh()
 	
 	def get_min_max(self, pool):
-		minx = min(pos.x for pos in pool._chunks)
-		maxx = max(pos.x for pos in pool._chunks)
-		miny = min(pos.y for pos in pool._chunks)
-		maxy = max(pos.y for pos in pool._chunks)
-		
-		return minx, maxx, miny, maxy
+		return pool.bounds() or (0, 0, 0, 0)
 	
 	def get_size(self):
-		minx, maxx, miny, maxy = self.get_min_max()
+		minx, maxx, miny, maxy = self.get_min_max(self.chunkpool)
 		return maxx - minx, maxy - miny
 	
 	def style_of(self, pos, chunk):
@@ -300,7 +432,7 @@ class ChunkMap():
 			return self.STYLE_UNLOAD
 		elif not chunk.empty():
 			return self.STYLE_NORMAL
-		elif pos in self.map_.visible_chunk_coords():
+		elif pos in self.map_.visible_chunk_set():
 			return self.STYLE_VISIBLE
 		else:
 			return self.STYLE_EMPTY
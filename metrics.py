@@ -0,0 +1,151 @@
+"""
+Runtime metrics for the server.
+
+Counters count events or amounts (e. g. bytes), histograms collect durations
+in seconds and gauges are functions that are only called when a snapshot is
+taken (e. g. the number of loaded chunks).
+
+The server records everything in the module's metrics object. Clients can
+request a snapshot with a "stats" message, and the server can also print a
+summary line periodically.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+class Histogram():
+	"""
+	Counts values in buckets that grow exponentially, four per power of ten,
+	from 1 µs to 100 s. Percentiles are estimated as the upper bound of the
+	bucket they fall into, or the largest value if that is smaller.
+	"""
+	
+	BOUNDS = [10**(exp/4) for exp in range(-24, 9)]
+	
+	def __init__(self):
+		self.buckets = [0]*(len(self.BOUNDS) + 1)
+		self.count = 0
+		self.total = 0
+		self.max = 0
+	
+	def observe(self, value):
+		self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+		self.count += 1
+		self.total += value
+		self.max = max(self.max, value)
+	
+	def percentile(self, p):
+		if not self.count:
+			return 0
+		
+		rank = p*self.count
+		seen = 0
+		for i, amount in enumerate(self.buckets):
+			seen += amount
+			if seen >= rank:
+				return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+		
+		return self.max
+	
+	def to_dict(self):
+		return {
+			"count": self.count,
+			"mean": self.total/self.count if self.count else 0,
+			"p50": self.percentile(.5),
+			"p99": self.percentile(.99),
+			"max": self.max,
+		}
+
+class Metrics():
+	def __init__(self):
+		self._counters = {}
+		self._histograms = {}
+		self._gauges = {}
+		self._gauge_groups = []
+		self._lock = threading.Lock()
+	
+	def count(self, name, amount=1):
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + amount
+	
+	def observe(self, name, seconds):
+		with self._lock:
+			histogram = self._histograms.get(name)
+			if not histogram:
+				histogram = Histogram()
+				self._histograms[name] = histogram
+			
+			histogram.observe(seconds)
+	
+	@contextmanager
+	def timed(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start)
+	
+	def gauge(self, name, func):
+		"""
+		Register a function whose result is included in each snapshot.
+		"""
+		
+		with self._lock:
+			self._gauges[name] = func
+	
+	def gauges(self, func):
+		"""
+		Register a function which returns a dict of gauges, for gauges that
+		are cheaper to get together.
+		"""
+		
+		with self._lock:
+			self._gauge_groups.append(func)
+	
+	def snapshot(self):
+		with self._lock:
+			counters = dict(self._counters)
+			histograms = {name: histogram.to_dict() for name, histogram in self._histograms.items()}
+			gauges = dict(self._gauges)
+			gauge_groups = list(self._gauge_groups)
+		
+		gauge_values = {name: func() for name, func in gauges.items()}
+		for func in gauge_groups:
+			gauge_values.update(func())
+		
+		return {
+			"counters": counters,
+			"histograms": histograms,
+			"gauges": gauge_values,
+		}
+	
+	def summary(self):
+		"""
+		A single line with the gauges, counters and the p99 of all histograms.
+		"""
+		
+		snapshot = self.snapshot()
+		
+		parts = []
+		for name, value in sorted(snapshot["gauges"].items()):
+			parts.append("{}={}".format(name, value))
+		for name, value in sorted(snapshot["counters"].items()):
+			parts.append("{}={}".format(name, value))
+		for name, histogram in sorted(snapshot["histograms"].items()):
+			parts.append("{}.p99={:.2f}ms".format(name, histogram["p99"]*1000))
+		
+		return " ".join(parts)
+	
+	def log_periodically(self, period):
+		def log():
+			while True:
+				time.sleep(period)
+				print("stats: {}".format(self.summary()))
+		
+		thread = threading.Thread(target=log, name="stats_thread", daemon=True)
+		thread.start()
+		return thread
+
+metrics = Metrics()
@@ -0,0 +1,148 @@
+"""
+Messages are sent as JSON by default:
+  {"type": "request-chunks", "data": [[x, y], ...]}
+  {"type": "unload-chunks",  "data": [[x, y], ...]}
+  {"type": "save-changes",   "data": [[[x, y], {index: char, ...}], ...]}
+  {"type": "apply-changes",  "data": [[[x, y], {index: char, ...}], ...]}
+
+With the "viewport" feature, the client doesn't request and unload chunks
+itself. Instead, it tells the server which chunks it displays (in chunk
+coordinates), and the server loads the chunks within preload chunks of that
+rectangle and unloads the ones further away than unload chunks:
+  {"type": "viewport", "data": [x, y, width, height, preload, unload]}
+
+With the "versions" feature, the server tells the client the version of
+each chunk it sends, and the client tells the server which versions of the
+chunks it requests it still has (e. g. from before it unloaded them). Diffs
+sent by the server then bring a chunk from its base version to its version,
+or replace the whole chunk if the base version is -1:
+  {"type": "request-chunks", "data": [[x, y], [x, y, version, checksum], ...]}
+  {"type": "apply-changes",  "data": [[[x, y], {index: char, ...}, base, version], ...]}
+If the server still knows the version the client has, it only sends the
+changes since then (nothing, if the chunk is unchanged). The checksum is
+the chunk's checksum() at that version. When the client requests chunks
+via its viewport, it can add the versions it has as a seventh element:
+  {"type": "viewport", "data": [x, y, width, height, preload, unload, [[x, y, version, checksum], ...]]}
+
+A client can also ask for the server's runtime metrics (see metrics.py):
+  {"type": "stats"}
+which are answered with
+  {"type": "stats", "data": {"counters": ..., "histograms": ..., "gauges": ..., "connection": ...}}
+where "connection" is the traffic of the requesting client.
+
+After both sides agreed on the "binary" feature via a "hello" message, the
+messages above can also be sent as binary frames: One byte for the message
+type, followed by packed coordinates or packed diffs (see chunks.pack_diffs).
+All other messages stay JSON.
+"""
+
+import json
+import struct
+
+from chunks import jsonify_diffs, dejsonify_diffs, pack_diffs, unpack_diffs, pack_coords, unpack_coords
+from utils import Position
+
+FEATURES = {"binary", "viewport", "versions"}
+
+DIFF_MESSAGES = {"apply-changes", "save-changes"}
+COORD_MESSAGES = {"request-chunks", "unload-chunks"}
+
+_TYPE = struct.Struct("<B")
+_TYPE_IDS = {
+	"request-chunks": 1,
+	"unload-chunks": 2,
+	"save-changes": 3,
+	"apply-changes": 4,
+}
+_TYPE_NAMES = {i: mtype for mtype, i in _TYPE_IDS.items()}
+# the same messages with versions
+_VERSIONED_TYPE_IDS = {
+	"request-chunks": 5,
+	"apply-changes": 6,
+}
+_VERSIONED_TYPE_NAMES = {i: mtype for mtype, i in _VERSIONED_TYPE_IDS.items()}
+
+def binary_type(mtype):
+	"""
+	Whether messages of this type can be sent as binary frames.
+	"""
+	
+	return mtype in _TYPE_IDS
+
+def encode_json(mtype, data, versions=None):
+	"""
+	See the module's docstring for the versions.
+	"""
+	
+	if mtype in DIFF_MESSAGES:
+		data = jsonify_diffs(data)
+		if versions is not None:
+			data = [[pos, ddiff] + list(versions[pos]) for pos, ddiff in data]
+	elif mtype in COORD_MESSAGES:
+		versions = versions or {}
+		data = [[pos[0], pos[1]] + list(versions.get(pos, ())) for pos in data]
+	
+	return json.dumps({"type": mtype, "data": data})
+
+def decode_json(text):
+	message = json.loads(text)
+	mtype = message["type"]
+	data = message.get("data")
+	versions = {}
+	
+	if mtype in DIFF_MESSAGES:
+		versions = {Position(d[0][0], d[0][1]): (d[2], d[3]) for d in data if len(d) == 4}
+		data = dejsonify_diffs(data)
+	elif mtype in COORD_MESSAGES:
+		versions = {Position(c[0], c[1]): (c[2], c[3]) for c in data if len(c) == 4}
+		data = [Position(coor[0], coor[1]) for coor in data]
+	
+	return mtype, data, versions
+
+def encode_binary(mtype, data, versions=None):
+	if mtype not in _VERSIONED_TYPE_IDS:
+		versions = None
+	
+	if versions is None:
+		header = _TYPE.pack(_TYPE_IDS[mtype])
+	else:
+		header = _TYPE.pack(_VERSIONED_TYPE_IDS[mtype])
+	
+	if mtype in DIFF_MESSAGES:
+		return header + pack_diffs(data, versions)
+	else:
+		return header + pack_coords(data, versions)
+
+def decode_binary(frame):
+	"""
+	Raises a ValueError if the frame is malformed.
+	"""
+	
+	try:
+		type_id, = _TYPE.unpack_from(frame)
+		if type_id in _VERSIONED_TYPE_NAMES:
+			mtype = _VERSIONED_TYPE_NAMES[type_id]
+			versions = {}
+		else:
+			mtype = _TYPE_NAMES[type_id]
+			versions = None
+	except (struct.error, KeyError) as e:
+		raise ValueError("Unknown message type") from e
+	
+	if mtype in DIFF_MESSAGES:
+		data = unpack_diffs(frame, _TYPE.size, versions)
+	else:
+		data = unpack_coords(frame, _TYPE.size, versions)
+	
+	return mtype, data, versions or {}
+
+def decode(message):
+	"""
+	Decode a text or binary message into its type, data and versions.
+	The versions are empty for messages without them.
+	"""
+	
+	if isinstance(message, (bytes, bytearray)):
+		return decode_binary(message)
+	else:
+		return decode_json(message)
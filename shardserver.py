@@ -0,0 +1,288 @@
+"""
+Serves the world from several processes.
+
+The world is split into square regions of ShardedPool.region_size chunks,
+which are spread over worker processes (shards). Each shard has its own
+DBChunkPool and journal. All of them share the db file, so the same db can
+be served by server.py or with a different number of shards later. Both
+replay the journals left by the other on startup (see recover_journals()).
+
+The front process runs aioserver's connections. It keeps the subscriptions
+and the chunk locks, so changes are still sent to clients in order, and
+forwards all work on chunks to the shards. Messages concerning chunks of
+different shards are handled in parallel.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+import aioserver
+from aioserver import AsyncWotServer
+from chunks import ChunkPool
+from connection import parse_args, open_world
+from dbchunkpool import DBChunkPool, shard_journal_name, recover_journals
+from utils import Position
+
+# the DBChunkPool methods a shard executes for the front
+SHARD_METHODS = {"read_chunks", "write_diffs", "reverse_diffs", "stats", "save_changes", "expire", "remove_empty", "close"}
+
+def run_shard(conn, dbfile, index):
+	# the front process handles Ctrl+C and closes the shards
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	
+	pool = DBChunkPool(dbfile, journal_name=shard_journal_name(dbfile, index))
+	
+	# the chunks clients of the front are subscribed to, see ShardedPool.follow()
+	pinned = set()
+	pool.pinned = pinned.__contains__
+	shard_methods = {"pin": pinned.update, "unpin": pinned.difference_update}
+	
+	while True:
+		try:
+			request_id, method, args = conn.recv()
+		except EOFError:
+			# the front process died
+			pool.save_changes()
+			pool.close()
+			return
+		
+		try:
+			if method in shard_methods:
+				func = shard_methods[method]
+			elif method in SHARD_METHODS:
+				func = getattr(pool, method)
+			else:
+				raise ValueError("Unknown shard method: {!r}".format(method))
+			result, error = func(*args), None
+		except Exception as e:
+			result, error = None, e
+		
+		conn.send((request_id, result, error))
+		
+		if method == "close":
+			return
+
+class Shard():
+	"""
+	A worker process with its own DBChunkPool.
+	call() can be used from multiple threads at once.
+	"""
+	
+	def __init__(self, context, dbfile, index):
+		self._conn, child_conn = context.Pipe()
+		self.process = context.Process(
+			target=run_shard,
+			args=(child_conn, dbfile, index),
+			name="shard{}".format(index)
+		)
+		self.process.start()
+		child_conn.close()
+		
+		self._futures = {}
+		self._next_id = 0
+		self._lock = threading.Lock()
+		
+		self.receive_thread = threading.Thread(
+			target=self.receive_loop,
+			name="shard{}_receive_thread".format(index),
+			daemon=True
+		)
+		self.receive_thread.start()
+	
+	def call(self, method, *args):
+		"""
+		Returns a future for the result of the method.
+		"""
+		
+		future = concurrent.futures.Future()
+		
+		with self._lock:
+			request_id = self._next_id
+			self._next_id += 1
+			self._futures[request_id] = future
+			self._conn.send((request_id, method, args))
+		
+		return future
+	
+	def receive_loop(self):
+		while True:
+			try:
+				request_id, result, error = self._conn.recv()
+			except (EOFError, OSError):
+				break
+			
+			with self._lock:
+				future = self._futures.pop(request_id)
+			
+			if error:
+				future.set_exception(error)
+			else:
+				future.set_result(result)
+		
+		# the shard is gone, nobody is going to answer anymore
+		with self._lock:
+			futures, self._futures = self._futures, {}
+		for future in futures.values():
+			future.set_exception(EOFError("Shard stopped"))
+
+class ShardedPool(ChunkPool):
+	"""
+	Offers the DBChunkPool methods WotConnection uses, but executes them in
+	the shard owning the chunks. The chunk locks are held in this process.
+	"""
+	
+	region_size = 16 # neighbouring chunks are usually used together
+	
+	def __init__(self, dbfile, shards):
+		super().__init__()
+		
+		if shards < 1:
+			raise ValueError("Invalid number of shards: {}".format(shards))
+		
+		# before any shard opens the db, so they all start without journals
+		recover_journals(dbfile)
+		
+		context = multiprocessing.get_context("spawn")
+		self._shards = [Shard(context, dbfile, i) for i in range(shards)]
+	
+	def shard_of(self, pos):
+		region = Position(pos[0]//self.region_size, pos[1]//self.region_size)
+		return hash(region)%len(self._shards)
+	
+	def _split(self, coords):
+		parts = {}
+		for pos in coords:
+			parts.setdefault(self.shard_of(pos), []).append(pos)
+		
+		return parts
+	
+	def _call(self, calls):
+		"""
+		calls maps shards to a method and its arguments.
+		Calls all of them at once and returns their results.
+		"""
+		
+		futures = {i: self._shards[i].call(method, *args) for i, (method, args) in calls.items()}
+		return {i: future.result() for i, future in futures.items()}
+	
+	def _call_all(self, method, *args):
+		return self._call({i: (method, args) for i in range(len(self._shards))})
+	
+	def read_chunks(self, coords, versions=None):
+		calls = {}
+		for i, part in self._split(coords).items():
+			part_versions = {pos: versions[pos] for pos in part if pos in versions} if versions else None
+			calls[i] = ("read_chunks", (part, part_versions))
+		
+		diffs = {}
+		chunk_versions = {}
+		for part_diffs, part_versions in self._call(calls).values():
+			diffs.update(part_diffs)
+			chunk_versions.update(part_versions)
+		
+		return diffs, chunk_versions
+	
+	def write_diffs(self, diffs):
+		calls = {}
+		for i, part in self._split(diffs.keys()).items():
+			calls[i] = ("write_diffs", ({pos: diffs[pos] for pos in part},))
+		
+		versions = {}
+		for part_versions in self._call(calls).values():
+			versions.update(part_versions)
+		
+		return versions
+	
+	def reverse_diffs(self, diffs):
+		calls = {}
+		for i, part in self._split(diffs.keys()).items():
+			calls[i] = ("reverse_diffs", ({pos: diffs[pos] for pos in part},))
+		
+		reverse_diffs = {}
+		versions = {}
+		for part_diffs, part_versions in self._call(calls).values():
+			reverse_diffs.update(part_diffs)
+			versions.update(part_versions)
+		
+		return reverse_diffs, versions
+	
+	def stats(self):
+		stats = {}
+		for shard_stats in self._call_all("stats").values():
+			for name, value in shard_stats.items():
+				stats[name] = stats.get(name, 0) + value
+		
+		return stats
+	
+	def follow(self, subscriptions):
+		"""
+		Keep the shards informed about which chunks are subscribed, so they
+		don't unload them (see DBChunkPool.pinned()).
+		"""
+		
+		subscriptions.first_subscribed = self.pin
+		subscriptions.last_unsubscribed = self.unpin
+	
+	def pin(self, coords):
+		# no need to wait, calls to a shard are executed in order
+		for i, part in self._split(coords).items():
+			self._shards[i].call("pin", part)
+	
+	def unpin(self, coords):
+		for i, part in self._split(coords).items():
+			self._shards[i].call("unpin", part)
+	
+	def save_changes(self):
+		self._call_all("save_changes")
+	
+	def expire(self, now=None):
+		self._call_all("expire", now)
+	
+	def remove_empty(self):
+		self._call_all("remove_empty")
+	
+	def close(self):
+		self._call_all("close")
+		
+		for shard in self._shards:
+			shard.process.join()
+
+def main(argv):
+	if len(argv) == 1 or len(argv) > 5:
+		print("Usage:")
+		print("  {} dbfile [port [statsperiod [shards]]]".format(argv[0]))
+		print("  default port: 8000")
+		print("  default shards: number of cpus")
+		return
+	
+	args = parse_args(argv[:4])
+	if not args:
+		return
+	
+	dbfile, port, stats_period = args
+	
+	if len(argv) >= 5:
+		try:
+			shards = int(argv[4])
+		except ValueError:
+			shards = 0
+		
+		if shards < 1:
+			print("Invalid number of shards")
+			return
+	else:
+		shards = os.cpu_count() or 1
+	
+	print("Starting {} shards".format(shards))
+	pool = ShardedPool(dbfile, shards)
+	
+	open_world(AsyncWotServer, dbfile, stats_period, pool)
+	pool.follow(AsyncWotServer.subscriptions)
+	aioserver.run(port, max_workers=max(8, 2*shards))
+
+if __name__ == "__main__":
+	main(sys.argv)
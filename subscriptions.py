@@ -0,0 +1,72 @@
+import threading
+
+class SubscriptionIndex():
+	"""
+	Keeps track of which connections have which chunks loaded.
+	Allows for changes to be sent only to the connections that display the changed chunks.
+	"""
+	
+	def __init__(self):
+		self._subscribers = {}
+		self._lock = threading.Lock()
+	
+	def subscribe(self, conn, coords):
+		with self._lock:
+			first = []
+			for pos in coords:
+				conns = self._subscribers.get(pos)
+				if conns is None:
+					conns = self._subscribers[pos] = set()
+					first.append(pos)
+				conns.add(conn)
+			
+			if first:
+				self.first_subscribed(first)
+	
+	def unsubscribe(self, conn, coords):
+		with self._lock:
+			last = []
+			for pos in coords:
+				conns = self._subscribers.get(pos)
+				if conns:
+					conns.discard(conn)
+					if not conns:
+						del self._subscribers[pos]
+						last.append(pos)
+			
+			if last:
+				self.last_unsubscribed(last)
+	
+	def first_subscribed(self, coords):
+		"""
+		Called with the chunks that just got their first subscriber.
+		Called while holding the lock, so the calls are in the same order as
+		the changes. Meant to be replaced by the user.
+		"""
+		
+		pass
+	
+	def last_unsubscribed(self, coords):
+		"""
+		Called with the chunks that just lost their last subscriber.
+		See first_subscribed().
+		"""
+		
+		pass
+	
+	def subscribed(self, pos):
+		return pos in self._subscribers
+	
+	def distribute(self, diffs):
+		"""
+		Returns a dict which maps each connection to the diffs it is subscribed to.
+		"""
+		
+		per_conn = {}
+		
+		with self._lock:
+			for pos, diff in diffs.items():
+				for conn in self._subscribers.get(pos, ()):
+					per_conn.setdefault(conn, {})[pos] = diff
+		
+		return per_conn
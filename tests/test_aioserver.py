@@ -0,0 +1,206 @@
+import asyncio
+import concurrent.futures
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+	import aioserver
+	import websocket
+except ImportError:
+	aioserver = None
+
+import protocol
+from chunks import ChunkDiff
+from connection import open_world
+from utils import Position
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+def wait_for_port(port):
+	for _ in range(100):
+		try:
+			socket.create_connection(("127.0.0.1", port)).close()
+			return
+		except OSError:
+			time.sleep(.1)
+	raise RuntimeError("Server didn't start")
+
+@unittest.skipUnless(aioserver, "websockets is not available")
+class LoopbackTestCase(unittest.TestCase):
+	"""
+	Serves a world from a thread of the test process.
+	"""
+	
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		open_world(aioserver.AsyncWotServer, os.path.join(self.directory.name, "world.db"))
+		aioserver.AsyncWotServer.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+		
+		self.sockets = []
+		self.port = free_port()
+		self.loop = asyncio.new_event_loop()
+		self.task = self.loop.create_task(aioserver.serve(self.port))
+		self.thread = threading.Thread(target=self.serve)
+		self.thread.start()
+		wait_for_port(self.port)
+	
+	def serve(self):
+		asyncio.set_event_loop(self.loop)
+		try:
+			self.loop.run_until_complete(self.task)
+		except asyncio.CancelledError:
+			pass
+		finally:
+			self.loop.close()
+	
+	def tearDown(self):
+		# otherwise, closing the server waits for them
+		for ws in self.sockets:
+			ws.close()
+		
+		self.loop.call_soon_threadsafe(self.task.cancel)
+		self.thread.join()
+		aioserver.AsyncWotServer.executor.shutdown()
+		aioserver.AsyncWotServer.pool.close()
+		self.directory.cleanup()
+	
+	def connect(self):
+		ws = websocket.create_connection("ws://127.0.0.1:{}/".format(self.port), timeout=10)
+		self.sockets.append(ws)
+		return ws
+	
+	def receive(self, ws):
+		"""
+		Returns the next message, or the close code if the connection was closed.
+		"""
+		
+		opcode, data = ws.recv_data(control_frame=True)
+		if opcode == websocket.ABNF.OPCODE_CLOSE:
+			ws.shutdown() # the close frame was answered already
+			return struct.unpack("!H", data[:2])[0]
+		return data.decode() if opcode == websocket.ABNF.OPCODE_TEXT else data
+
+@unittest.skipUnless(aioserver, "websockets is not available")
+class TestBacklog(unittest.TestCase):
+	def test_backlog_is_counted_in_bytes(self):
+		class FakeWebsocket:
+			remote_address = ("127.0.0.1", 0)
+			
+			def __init__(self):
+				self.sent = []
+			
+			async def send(self, data):
+				self.sent.append(data)
+		
+		loop = asyncio.new_event_loop()
+		try:
+			websocket = FakeWebsocket()
+			conn = aioserver.AsyncWotServer(websocket, loop)
+			conn.sendMessage("ä\U0001f600")
+			conn.sendMessage(b"\x00\x01")
+			self.assertEqual(conn.backlog(), 2 + 4 + 2)
+			
+			sender = loop.create_task(conn.send_loop())
+			while len(websocket.sent) < 2:
+				loop.run_until_complete(asyncio.sleep(0))
+			self.assertEqual(conn.backlog(), 0)
+			
+			sender.cancel()
+			loop.run_until_complete(asyncio.gather(sender, return_exceptions=True))
+		finally:
+			loop.close()
+
+class TestMalformedMessages(LoopbackTestCase):
+	def test_malformed_messages_close_quietly(self):
+		messages = [
+			b"\xff",
+			"not json",
+			'{"data": []}',
+			'{"type": "save-changes", "data": [[]]}',
+			'{"type": "request-chunks", "data": 5}',
+		]
+		
+		with self.assertNoLogs("websockets", "ERROR"):
+			for message in messages:
+				ws = self.connect()
+				if isinstance(message, bytes):
+					ws.send_binary(message)
+				else:
+					ws.send(message)
+				self.assertEqual(self.receive(ws), 1007, message)
+		
+		# the others are still served
+		ws = self.connect()
+		ws.send('{"type": "request-chunks", "data": [[0, 0]]}')
+		self.assertIn("apply-changes", self.receive(ws))
+
+class TestLoopback(LoopbackTestCase):
+	def test_broadcast(self):
+		pos = Position(0, 0)
+		
+		# one client speaks the binary protocol with versions, the other plain JSON
+		writer, viewer = self.connect(), self.connect()
+		writer.send('{"type": "hello", "data": ["binary", "versions", "unknown"]}')
+		self.assertEqual(self.receive(writer), '{"type": "hello", "data": ["binary", "versions"]}')
+		
+		writer.send_binary(protocol.encode_binary("request-chunks", [pos], {}))
+		viewer.send('{"type": "request-chunks", "data": [[0, 0]]}')
+		for ws in (writer, viewer):
+			mtype, diffs, versions = protocol.decode(self.receive(ws))
+			self.assertEqual(mtype, "apply-changes")
+			self.assertEqual(diffs[pos].to_string().strip(), "")
+		
+		writer.send_binary(protocol.encode_binary("save-changes", {pos: ChunkDiff.from_dict({0: "a", 1: "ö"})}))
+		
+		mtype, diffs, versions = protocol.decode(self.receive(viewer))
+		self.assertEqual(mtype, "apply-changes")
+		self.assertEqual(diffs[pos].to_dict(), {0: "a", 1: "ö"})
+		self.assertEqual(versions, {})
+		
+		frame = self.receive(writer)
+		self.assertIsInstance(frame, bytes)
+		mtype, diffs, versions = protocol.decode(frame)
+		self.assertEqual(diffs[pos].to_dict(), {0: "a", 1: "ö"})
+		self.assertEqual(versions, {pos: (0, 1)})
+		
+		# the change is in the pool, and new clients get it too
+		late = self.connect()
+		late.send('{"type": "request-chunks", "data": [[0, 0]]}')
+		mtype, diffs, versions = protocol.decode(self.receive(late))
+		self.assertEqual(diffs[pos].to_string()[:2], "aö")
+
+@unittest.skipUnless(aioserver, "websockets is not available")
+class TestShutdown(unittest.TestCase):
+	def test_interrupt(self):
+		with tempfile.TemporaryDirectory() as directory:
+			port = free_port()
+			server = subprocess.Popen(
+				[sys.executable, os.path.join(ROOT, "aioserver.py"), os.path.join(directory, "world.db"), str(port)],
+				stdout=subprocess.PIPE,
+				stderr=subprocess.PIPE
+			)
+			try:
+				wait_for_port(port)
+			finally:
+				server.send_signal(signal.SIGINT)
+				out, err = server.communicate(timeout=30)
+		
+		self.assertEqual(server.returncode, 0)
+		self.assertIn(b"Stopped.", out)
+		self.assertEqual(err.decode(), "")
+
+if __name__ == "__main__":
+	unittest.main()
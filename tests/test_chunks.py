@@ -0,0 +1,188 @@
+import random
+import unittest
+
+from chunks import CHUNK_SIZE, Chunk, ChunkDiff, ChunkPool, split_legitimate
+from utils import CHUNK_WIDTH, Position
+
+class TestChunkDiff(unittest.TestCase):
+	def test_dict(self):
+		diff = ChunkDiff.from_dict({"0": "a", 5: "ä", 7: "\U0001f600", -1: "x", CHUNK_SIZE: "y"})
+		self.assertEqual(diff.to_dict(), {0: "a", 5: "ä", 7: "\U0001f600"})
+		self.assertEqual(len(diff.to_string()), CHUNK_SIZE)
+		self.assertEqual(diff.to_string()[:8], "a    ä \U0001f600")
+		self.assertTrue(diff.legitimate())
+	
+	def test_invalid_cells(self):
+		diff = ChunkDiff.from_dict({0: "a", 1: "ab", 2: None})
+		self.assertEqual(set(diff.to_dict()), {0, 1, 2})
+		self.assertFalse(diff.legitimate())
+		
+		rest, invalid = diff.split(0b110)
+		self.assertEqual(rest.to_dict(), {0: "a"})
+		self.assertTrue(rest.legitimate())
+		self.assertFalse(invalid.legitimate())
+	
+	def test_string(self):
+		diff = ChunkDiff.from_string("ab")
+		self.assertEqual(diff.to_dict(), {0: "a", 1: "b"})
+		
+		full = ChunkDiff.from_string("x"*(CHUNK_SIZE + 10))
+		self.assertEqual(full.to_string(), "x"*CHUNK_SIZE)
+		self.assertEqual(len(full.to_dict()), CHUNK_SIZE)
+	
+	def test_apply(self):
+		diff = ChunkDiff.from_dict({0: "a", 1: "b"})
+		diff.set(1, 0, "c")
+		diff.delete(2, 0)
+		diff.set(0, 1, "d")
+		self.assertEqual(diff.to_dict(), {0: "a", 1: "c", 2: " ", CHUNK_WIDTH: "d"})
+		
+		combined = diff.combine(ChunkDiff.from_dict({0: "e", 3: "f"}))
+		self.assertEqual(combined.to_dict(), {0: "e", 1: "c", 2: " ", 3: "f", CHUNK_WIDTH: "d"})
+		self.assertEqual(diff.to_dict()[0], "a")
+		
+		combined.clear_deletions()
+		self.assertEqual(combined.to_dict(), {0: "e", 1: "c", 3: "f", CHUNK_WIDTH: "d"})
+	
+	def test_diff(self):
+		chunk = ChunkDiff.from_dict({0: "a", 1: "b"})
+		diff = ChunkDiff.from_dict({1: "x", 2: "y"})
+		self.assertEqual(diff.diff(chunk).to_dict(), {1: "b", 2: " "})
+
+class TestCaches(unittest.TestCase):
+	def assert_encodings(self, diff, expected):
+		self.assertEqual(diff.to_string(), expected.to_string())
+		self.assertEqual(diff.to_dict(), expected.to_dict())
+		self.assertEqual(diff.to_bytes(), expected.to_bytes())
+		self.assertEqual(diff.checksum(), expected.checksum())
+	
+	def test_chunk_diff(self):
+		diff = ChunkDiff.from_dict({0: "a"})
+		self.assertIs(diff.to_bytes(), diff.to_bytes())
+		self.assertIs(diff.to_dict(), diff.to_dict())
+		
+		changes = [
+			(lambda: diff.set(1, 0, "b"), {0: "a", 1: "b"}),
+			(lambda: diff.delete(0, 0), {0: " ", 1: "b"}),
+			(diff.clear_deletions, {1: "b"}),
+			(lambda: diff.apply(ChunkDiff.from_dict({2: "c"})), {1: "b", 2: "c"}),
+		]
+		for change, expected in changes:
+			self.assert_encodings(diff, diff.copy()) # fills the caches
+			change()
+			self.assert_encodings(diff, ChunkDiff.from_dict(expected))
+	
+	def test_chunk(self):
+		chunk = Chunk()
+		self.assertIs(chunk.as_diff(), chunk.as_diff())
+		self.assertIs(chunk.lines(), chunk.lines())
+		
+		changes = [
+			(lambda: chunk.set(0, 0, "a"), "a"),
+			(lambda: chunk.delete(0, 0), " "),
+			(lambda: chunk.apply_diff(ChunkDiff.from_dict({1: "b"})), " b"),
+			(chunk.commit_changes, " b"),
+			(lambda: chunk.commit_diff(ChunkDiff.from_dict({1: "c", 2: "d"})), " cd"),
+			(lambda: chunk.set(3, 0, "e"), " cde"),
+			(chunk.drop_changes, " cd"),
+		]
+		for change, expected in changes:
+			chunk.lines()
+			chunk.checksum()
+			change()
+			
+			expected = ChunkDiff.from_string(expected.ljust(CHUNK_SIZE))
+			self.assertEqual(chunk.to_string(), expected.to_string())
+			self.assertEqual(chunk.lines(), expected.lines())
+			self.assertEqual(chunk.checksum(), expected.checksum())
+
+class TestSplitLegitimate(unittest.TestCase):
+	def test_split(self):
+		diffs = {
+			Position(0, 0): ChunkDiff.from_dict({0: "a", 1: "b"}),
+			Position(1, 0): ChunkDiff.from_dict({0: "a", 1: "\n"}),
+			Position(2, 0): ChunkDiff.from_dict({0: "\t", 1: "ab"}),
+		}
+		legitimate, illegitimate = split_legitimate(diffs)
+		
+		self.assertEqual(set(legitimate), {Position(0, 0), Position(1, 0)})
+		self.assertEqual(set(illegitimate), {Position(1, 0), Position(2, 0)})
+		self.assertEqual(legitimate[Position(1, 0)].to_dict(), {0: "a"})
+		self.assertEqual(illegitimate[Position(1, 0)].to_dict(), {1: "\n"})
+		self.assertEqual(set(illegitimate[Position(2, 0)].to_dict()), {0, 1})
+	
+	def test_no_empty_diffs(self):
+		diffs = {
+			Position(0, 0): ChunkDiff(),
+			Position(1, 0): ChunkDiff.from_dict({-1: "a", 10000: "b"}),
+			Position(2, 0): ChunkDiff.from_dict({0: "\n"}),
+		}
+		legitimate, illegitimate = split_legitimate(diffs)
+		
+		self.assertEqual(legitimate, {})
+		self.assertEqual(list(illegitimate), [Position(2, 0)])
+
+class TestChunkPoolIndex(unittest.TestCase):
+	def setUp(self):
+		self.random = random.Random(0)
+		self.pool = ChunkPool()
+		for _ in range(500):
+			self.pool.create(Position(self.random.randrange(-60, 60), self.random.randrange(-60, 60)))
+	
+	def rectangles(self):
+		yield 0, 0, 0, 5
+		yield -16, -16, 32, 32 # exactly four buckets
+		yield -100, -100, 200, 200 # more buckets than there are
+		for _ in range(200):
+			yield (
+				self.random.randrange(-80, 80), self.random.randrange(-80, 80),
+				self.random.randrange(1, 60), self.random.randrange(1, 60)
+			)
+	
+	def assert_index(self):
+		coords = set(self.pool._chunks)
+		for x, y, width, height in self.rectangles():
+			inside = {pos for pos in coords if x <= pos.x < x + width and y <= pos.y < y + height}
+			
+			result = self.pool.chunks_inside(x, y, width, height)
+			self.assertEqual(len(result), len(set(result)))
+			self.assertEqual(set(result), inside)
+			
+			result = self.pool.chunks_outside(x, y, width, height)
+			self.assertEqual(len(result), len(set(result)))
+			self.assertEqual(set(result), coords - inside)
+		
+		self.assertEqual(self.pool.bounds(), (
+			min(pos.x for pos in coords), max(pos.x for pos in coords),
+			min(pos.y for pos in coords), max(pos.y for pos in coords)
+		))
+	
+	def test_queries(self):
+		self.assert_index()
+	
+	def test_queries_after_unload(self):
+		coords = sorted(self.pool._chunks)
+		# the chunks on the border are unloaded first
+		self.pool.unload_list(coords[:100] + coords[-100:])
+		self.assert_index()
+		
+		self.pool.create(Position(1000, -1000))
+		self.assert_index()
+	
+	def test_empty_pool(self):
+		self.pool.unload_list(list(self.pool._chunks))
+		self.assertIsNone(self.pool.bounds())
+		self.assertEqual(self.pool._buckets, {})
+		self.assertEqual(self.pool.chunks_inside(-10, -10, 20, 20), [])
+		self.assertEqual(self.pool.chunks_outside(-10, -10, 20, 20), [])
+	
+	def test_clean_up_outside(self):
+		inside = set(self.pool.chunks_inside(-10, -10, 20, 20))
+		self.pool.create(Position(100, 100))
+		
+		self.pool.clean_up(except_for=[Position(100, 100)], outside=(-10, -10, 20, 20))
+		self.assertEqual(set(self.pool._chunks), inside | {Position(100, 100)})
+		self.assertTrue(inside)
+
+if __name__ == "__main__":
+	unittest.main()
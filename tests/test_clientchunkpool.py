@@ -0,0 +1,155 @@
+import os
+import tempfile
+import unittest
+
+from chunks import ChunkDiff
+from clientchunkpool import ClientChunkPool
+from dbchunkpool import DBChunkPool
+from utils import Position
+
+P = Position(0, 0)
+
+class FakeClient():
+	"""
+	Answers requests from a DBChunkPool, like a server would.
+	"""
+	
+	def __init__(self, server, versions=True):
+		self.server = server
+		self.versions = versions
+		self.requests = []
+		self.pool = None
+	
+	def request_chunks(self, coords, versions=None):
+		self.requests.append((list(coords), versions))
+	
+	def answer(self):
+		requests, self.requests = self.requests, []
+		for coords, versions in requests:
+			diffs, chunk_versions = self.server.read_chunks(coords, versions if self.versions else None)
+			self.pool.commit_diffs(diffs, chunk_versions if self.versions else None)
+	
+	def unload_chunks(self, coords):
+		pass
+	
+	def send_changes(self, diffs):
+		pass
+	
+	def redraw(self):
+		pass
+
+class ClientPoolTestCase(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.server = DBChunkPool(os.path.join(self.directory.name, "world.db"), journal=False)
+		self.server.history_length = 2
+	
+	def tearDown(self):
+		self.server.close()
+		self.directory.cleanup()
+	
+	def client_pool(self, versions=True, cachefile=None):
+		client = FakeClient(self.server, versions)
+		pool = ClientChunkPool(client, cachefile)
+		client.pool = pool
+		return client, pool
+	
+	def write(self, d):
+		"""
+		Change the server's chunk and return the diffs and versions to broadcast.
+		"""
+		
+		diffs = {P: ChunkDiff.from_dict(d)}
+		return diffs, self.server.write_diffs(diffs)
+	
+	def assert_same(self, pool):
+		self.assertEqual(pool.get(P).to_string(), self.server.get(P).to_string())
+		self.assertEqual(pool.get(P).version, self.server.get(P).version)
+
+class TestVersions(ClientPoolTestCase):
+	def test_full_answer_replaces_chunk(self):
+		client, pool = self.client_pool()
+		self.write({0: "a", 1: "b", 2: "c"})
+		
+		pool.load_list([P])
+		client.answer()
+		pool.unload_list([P])
+		
+		# delete a cell, then forget the history the client could catch up with
+		self.write({1: " "})
+		for i in range(3):
+			self.write({10 + i: "x"})
+		
+		pool.load_list([P])
+		client.answer()
+		
+		self.assert_same(pool)
+		self.assertEqual(pool.get(P).to_string()[:3], "a c")
+		self.assertFalse(pool._requested)
+	
+	def test_catch_up(self):
+		client, pool = self.client_pool()
+		self.write({0: "a"})
+		
+		pool.load_list([P])
+		client.answer()
+		pool.unload_list([P])
+		
+		self.write({0: " "})
+		
+		pool.load_list([P])
+		self.assertEqual(client.requests[0][1][P][0], 1)
+		client.answer()
+		
+		self.assert_same(pool)
+	
+	def test_stale_chunk_keeps_modifications(self):
+		client, pool = self.client_pool()
+		self.write({0: "a"})
+		
+		pool.load_list([P])
+		client.answer()
+		pool.get(P).set(5, 0, "m")
+		
+		# the client missed a change, so the next one doesn't fit
+		self.write({1: "b"})
+		diffs, versions = self.write({2: "c"})
+		pool.commit_diffs(diffs, versions)
+		
+		# changes arriving before the answer are ignored
+		diffs, versions = self.write({3: "d"})
+		pool.commit_diffs(diffs, versions)
+		self.assertEqual(len(client.requests), 1)
+		
+		client.answer()
+		
+		chunk = pool.get(P)
+		self.assertEqual(chunk.version, self.server.get(P).version)
+		self.assertEqual(chunk.to_string()[:6], "abcd m")
+		self.assertTrue(chunk.modified())
+
+class TestRestore(ClientPoolTestCase):
+	def test_cached_chunk_is_replaced(self):
+		cachefile = os.path.join(self.directory.name, "cache.db")
+		self.write({0: "a"})
+		
+		client, pool = self.client_pool(versions=False, cachefile=cachefile)
+		pool.load_list([P])
+		client.answer()
+		pool.close()
+		
+		# the chunk is blank on the server now, and saving leaves the blank cells out of its diff
+		self.write({0: " "})
+		self.server.save_changes()
+		
+		client, pool = self.client_pool(versions=False, cachefile=cachefile)
+		pool.load_list([P])
+		self.assertEqual(pool.get(P).to_string()[0], "a")
+		client.answer()
+		
+		self.assertEqual(pool.get(P).to_string(), self.server.get(P).to_string())
+		self.assertFalse(pool._requested)
+		pool.close()
+
+if __name__ == "__main__":
+	unittest.main()
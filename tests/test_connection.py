@@ -0,0 +1,327 @@
+import json
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+import protocol
+from chunks import ChunkDiff
+from connection import WotConnection, open_world
+from utils import Position
+
+try:
+	import server
+except ImportError:
+	server = None
+
+class FakeConnection(WotConnection):
+	def __init__(self):
+		self.address = ("127.0.0.1", 0)
+		self.sent = []
+		self.queued = 0 # pretend this many bytes are still waiting to be sent
+		self.dropped = False
+	
+	def sendMessage(self, message):
+		self.sent.append(message)
+	
+	def backlog(self):
+		return self.queued
+	
+	def drop(self):
+		self.dropped = True
+	
+	def received(self):
+		"""
+		Returns the cells of all apply-changes messages, and forgets them.
+		"""
+		
+		cells = {}
+		for message in self.sent:
+			message = json.loads(message)
+			if message["type"] == "apply-changes":
+				for pos, diff in message["data"]:
+					cells.setdefault(tuple(pos), {}).update(diff)
+		
+		self.sent = []
+		return cells
+
+class WorldTestCase(unittest.TestCase):
+	def open_world(self, cls):
+		self.directory = tempfile.TemporaryDirectory()
+		open_world(cls, os.path.join(self.directory.name, "world.db"))
+		self.cls = cls
+	
+	def tearDown(self):
+		self.cls.pool.close()
+		self.directory.cleanup()
+	
+	def assert_gone(self, conn, coords):
+		self.assertNotIn(conn, self.cls.clients)
+		for pos in coords:
+			self.assertFalse(self.cls.subscriptions.subscribed(pos))
+			self.assertNotIn(conn, self.cls.subscriptions.distribute({pos: None}))
+
+class TestDisconnect(WorldTestCase):
+	def test_disconnected_removes_client(self):
+		class Conn(FakeConnection):
+			pass
+		self.open_world(Conn)
+		
+		coords = [Position(0, 0), Position(1, 0)]
+		for _ in range(3):
+			conn = Conn()
+			conn.connected()
+			conn.handle_request_chunks(coords)
+			self.assertIn(conn, Conn.clients)
+			self.assertTrue(Conn.subscriptions.subscribed(coords[0]))
+			
+			conn.disconnected()
+			self.assert_gone(conn, coords)
+		
+		self.assertEqual(Conn.clients, [])
+	
+	@unittest.skipUnless(server, "SimpleWebSocketServer is not available")
+	def test_wotserver_handle_close(self):
+		class Server(server.WotServer):
+			pass
+		self.open_world(Server)
+		
+		sock, other = socket.socketpair()
+		self.addCleanup(sock.close)
+		self.addCleanup(other.close)
+		
+		conn = Server(None, sock, ("127.0.0.1", 0))
+		conn.handleConnected()
+		conn.handle_request_chunks([Position(0, 0)])
+		conn.handleClose()
+		
+		self.assert_gone(conn, [Position(0, 0)])
+
+class TestTraffic(WorldTestCase):
+	def test_bytes_in_counts_bytes(self):
+		class Conn(FakeConnection):
+			pass
+		self.open_world(Conn)
+		
+		conn = Conn()
+		conn.connected()
+		
+		message = json.dumps({"type": "save-changes", "data": [[[0, 0], {"0": "ä"}]]}, ensure_ascii=False)
+		conn.handle_message(message)
+		self.assertEqual(conn.bytes_in, len(message) + 1)
+		
+		frame = protocol.encode_binary("save-changes", {Position(0, 0): ChunkDiff.from_dict({1: "ö"})})
+		conn.handle_message(frame)
+		self.assertEqual(conn.bytes_in, len(message) + 1 + len(frame))
+		self.assertEqual(Conn.pool.get(Position(0, 0)).to_string()[:2], "äö")
+
+	def test_stats_only_show_own_connection(self):
+		class Conn(FakeConnection):
+			pass
+		self.open_world(Conn)
+		
+		other, conn = Conn(), Conn()
+		other.address = ("10.1.2.3", 4567)
+		for c in (other, conn):
+			c.connected()
+		other.handle_message(json.dumps({"type": "request-chunks", "data": [[0, 0]]}))
+		
+		conn.handle_message(json.dumps({"type": "stats"}))
+		message = conn.sent[-1]
+		self.assertNotIn("10.1.2.3", message)
+		self.assertNotIn("127.0.0.1", message)
+		
+		stats = json.loads(message)["data"]
+		self.assertEqual(stats["connection"], {"bytes_in": len('{"type": "stats"}'), "bytes_out": 0})
+
+class TestViewport(WorldTestCase):
+	def setUp(self):
+		class Conn(FakeConnection):
+			max_viewport_chunks = 64
+		self.open_world(Conn)
+		
+		self.conn = Conn()
+		self.conn.connected()
+		self.conn.handle_hello(["viewport"])
+		self.conn.sent = []
+	
+	def viewport(self, *viewport):
+		self.conn.handle_message(json.dumps({"type": "viewport", "data": viewport}))
+		return set(self.conn.received())
+	
+	def assert_loaded(self, xs, ys):
+		coords = {Position(x, y) for x in xs for y in ys}
+		self.assertEqual(self.conn.loaded_chunks, coords)
+		for pos in coords:
+			self.assertTrue(self.cls.subscriptions.subscribed(pos))
+	
+	def test_scrolling(self):
+		self.assertEqual(self.viewport(0, 0, 2, 2, 0, 0), {(0, 0), (1, 0), (0, 1), (1, 1)})
+		self.assert_loaded(range(2), range(2))
+		
+		# only the new strip is loaded, and the old one unloaded
+		self.assertEqual(self.viewport(1, 0, 2, 2, 0, 0), {(2, 0), (2, 1)})
+		self.assert_loaded(range(1, 3), range(2))
+		self.assertFalse(self.cls.subscriptions.subscribed(Position(0, 0)))
+		
+		self.assertEqual(self.viewport(1, 0, 2, 2, 0, 0), set())
+		self.assertEqual(self.viewport(1, -1, 2, 2, 0, 0), {(1, -1), (2, -1)})
+		self.assert_loaded(range(1, 3), range(-1, 1))
+	
+	def test_unload_margin(self):
+		self.viewport(0, 0, 2, 2, 0, 1)
+		
+		# the chunks within the unload margin stay loaded
+		self.assertEqual(self.viewport(1, 0, 2, 2, 0, 1), {(2, 0), (2, 1)})
+		self.assert_loaded(range(3), range(2))
+		
+		self.assertEqual(self.viewport(3, 0, 2, 2, 0, 1), {(3, 0), (4, 0), (3, 1), (4, 1)})
+		self.assert_loaded(range(2, 5), range(2))
+	
+	def test_preload(self):
+		self.assertEqual(len(self.viewport(0, 0, 1, 1, 1, 0)), 9)
+		self.assert_loaded(range(-1, 2), range(-1, 2))
+		
+		# the unload margin is at least the preload margin
+		self.assertEqual(self.viewport(0, 0, 1, 1, 1, 0), set())
+		self.assert_loaded(range(-1, 2), range(-1, 2))
+		
+		self.assertEqual(self.viewport(1, 0, 1, 1, 1, 0), {(2, -1), (2, 0), (2, 1)})
+		self.assert_loaded(range(0, 3), range(-1, 2))
+	
+	def test_invalid_viewports_are_ignored(self):
+		self.viewport(0, 0, 2, 2, 0, 0)
+		
+		for viewport in [
+			(0, 0, 9, 8, 0, 0), # too many chunks
+			(0, 0, 4, 4, 3, 0), # too many chunks with the preload margin
+			(5, 5, -1, 2, 0, 0),
+			(5, 5, 2, -1, 0, 0),
+			(5, 5, 2, 2, -1, 0),
+			(5, 5, 2, 2),
+			(5, 5, 2, 2, "x", 0),
+		]:
+			self.assertEqual(self.viewport(*viewport), set(), viewport)
+			self.assert_loaded(range(2), range(2))
+		
+		# the largest allowed viewport
+		self.assertEqual(len(self.viewport(0, 0, 6, 6, 1, 0)), 64 - 4)
+	
+	def test_known_versions(self):
+		self.conn.handle_hello(["viewport", "versions"])
+		pos = Position(0, 0)
+		
+		writer = self.cls()
+		writer.connected()
+		writer.handle_save_changes({pos: ChunkDiff.from_dict({0: "a"})})
+		chunk = self.cls.pool.get(pos)
+		version, checksum = chunk.version, chunk.checksum()
+		writer.handle_save_changes({pos: ChunkDiff.from_dict({1: "b"})})
+		self.conn.sent = []
+		
+		# only the changes since the client's version, and the whole other chunk
+		self.conn.handle_viewport([0, 0, 2, 1, 0, 0, [[0, 0, version, checksum], [1, 0, 5, 0], [7]]])
+		self.assertEqual(len(self.conn.sent), 1)
+		data = json.loads(self.conn.sent[0])["data"]
+		self.assertEqual(data, [
+			[[0, 0], {"1": "b"}, version, version + 1],
+			[[1, 0], {}, -1, 0],
+		])
+
+class TestBroadcast(WorldTestCase):
+	def test_changes_are_encoded_once(self):
+		class Conn(FakeConnection):
+			pass
+		self.open_world(Conn)
+		
+		clients = [Conn() for _ in range(5)]
+		for conn in clients:
+			conn.connected()
+			conn.handle_hello(["binary"])
+			conn.handle_request_chunks([Position(0, 0)])
+			conn.sent = []
+		
+		with mock.patch.object(ChunkDiff, "_to_bytes", autospec=True, side_effect=ChunkDiff._to_bytes) as encode:
+			clients[0].handle_save_changes({Position(0, 0): ChunkDiff.from_dict({0: "a"})})
+			Conn.flush_all()
+		
+		self.assertEqual(encode.call_count, 1)
+		self.assertEqual(len({conn.sent[0] for conn in clients}), 1)
+	
+	def test_merging_doesnt_change_other_clients(self):
+		class Conn(FakeConnection):
+			pass
+		self.open_world(Conn)
+		
+		waiting, other = Conn(), Conn()
+		for conn in (waiting, other):
+			conn.connected()
+			conn.handle_request_chunks([Position(0, 0)])
+			conn.received()
+		
+		diff = ChunkDiff.from_dict({0: "a"})
+		waiting.send_changes({Position(0, 0): diff}, {Position(0, 0): (0, 1)})
+		other.send_changes({Position(0, 0): diff}, {Position(0, 0): (0, 1)})
+		other.flush_changes()
+		waiting.send_changes({Position(0, 0): ChunkDiff.from_dict({1: "b"})}, {Position(0, 0): (1, 2)})
+		waiting.flush_changes()
+		
+		self.assertEqual(diff.to_dict(), {0: "a"})
+		self.assertEqual(other.received(), {(0, 0): {"0": "a"}})
+		self.assertEqual(waiting.received(), {(0, 0): {"0": "a", "1": "b"}})
+
+class TestSlowClients(WorldTestCase):
+	def connect(self, policy):
+		class Conn(FakeConnection):
+			slow_client_policy = policy
+			max_backlog = 100
+		self.open_world(Conn)
+		
+		slow, writer = Conn(), Conn()
+		for conn in (slow, writer):
+			conn.connected()
+			conn.handle_request_chunks([Position(0, 0)])
+			conn.received()
+		
+		slow.queued = 1000
+		writer.handle_save_changes({Position(0, 0): ChunkDiff.from_dict({0: "a"})})
+		Conn.flush_all()
+		return Conn, slow, writer
+	
+	def test_merge(self):
+		Conn, slow, writer = self.connect("merge")
+		writer.handle_save_changes({Position(0, 0): ChunkDiff.from_dict({1: "b"})})
+		Conn.flush_all()
+		self.assertEqual(slow.received(), {})
+		
+		slow.queued = 0
+		Conn.flush_all()
+		self.assertEqual(slow.received(), {(0, 0): {"0": "a", "1": "b"}})
+	
+	def test_resync(self):
+		Conn, slow, writer = self.connect("resync")
+		Conn.resync_all()
+		self.assertEqual(slow.received(), {})
+		
+		slow.queued = 0
+		Conn.resync_all()
+		cells = slow.received()[(0, 0)]
+		self.assertEqual(cells["0"], "a")
+		self.assertEqual(len(cells), 512) # all cells, so missed deletions are applied too
+		
+		Conn.resync_all()
+		self.assertEqual(slow.received(), {})
+	
+	def test_drop(self):
+		Conn, slow, writer = self.connect("drop")
+		self.assertTrue(slow.dropped)
+		self.assertFalse(writer.dropped)
+		
+		writer.handle_save_changes({Position(0, 0): ChunkDiff.from_dict({1: "b"})})
+		Conn.flush_all()
+		self.assertEqual(slow.received(), {})
+		self.assertIn((0, 0), writer.received())
+
+if __name__ == "__main__":
+	unittest.main()
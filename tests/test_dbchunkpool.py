@@ -0,0 +1,161 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from chunks import Chunk, ChunkDiff
+from dbchunkpool import DBChunkPool, shard_journal_name, journal_names, recover_journals
+from utils import Position
+
+A, B, C = Position(0, 0), Position(1, 0), Position(0, 1)
+
+class PoolTestCase(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.pool = DBChunkPool(os.path.join(self.directory.name, "world.db"), journal=False)
+	
+	def tearDown(self):
+		self.pool.close()
+		self.directory.cleanup()
+
+class TestCounters(PoolTestCase):
+	def test_concurrent_loads(self):
+		self.pool.max_chunks = 8
+		threads = 8
+		rounds = 200
+		
+		def load(n):
+			for i in range(rounds):
+				self.pool.load_list([Position(n, 1 + i % 16), Position(n, 0)])
+		
+		workers = [threading.Thread(target=load, args=(n,)) for n in range(threads)]
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+		
+		stats = self.pool.stats()
+		self.assertEqual(stats["pool_hits"] + stats["pool_misses"], threads * rounds * 2)
+		self.assertEqual(stats["pool_misses"] - stats["pool_evictions"], stats["chunks"])
+
+class TestExpiry(PoolTestCase):
+	def setUp(self):
+		super().setUp()
+		self.pool.max_age = 10
+		self.now = time.time()
+	
+	def test_expire(self):
+		self.pool.load_list([A, B])
+		
+		self.pool.expire(self.now + 5)
+		self.assertEqual(set(self.pool._chunks), {A, B})
+		
+		self.pool.expire(self.now + 20)
+		self.assertEqual(self.pool._chunks, {})
+		self.assertEqual(self.pool._expiry, [])
+		self.assertEqual(self.pool.stats()["pool_expirations"], 2)
+	
+	def test_only_due_chunks_are_looked_at(self):
+		looked_at = []
+		self.pool.pinned = lambda pos: looked_at.append(pos) or pos == B
+		
+		self.pool.load_list([A, B])
+		chunk = Chunk()
+		chunk.touch(self.now + 100)
+		self.pool.set(C, chunk)
+		
+		self.pool.expire(self.now + 20)
+		self.assertEqual(sorted(looked_at), [A, B])
+		self.assertEqual(set(self.pool._chunks), {B, C})
+		
+		# the pinned chunk is looked at again after another max_age
+		del looked_at[:]
+		self.pool.expire(self.now + 25)
+		self.assertEqual(looked_at, [])
+		self.pool.expire(self.now + 31)
+		self.assertEqual(looked_at, [B])
+	
+	def test_unsaved_chunks_are_kept(self):
+		self.pool.load_list([A])
+		self.pool.write_diffs({A: ChunkDiff.from_dict({0: "a"})})
+		
+		self.pool.expire(self.now + 20)
+		self.assertIn(A, self.pool._chunks)
+		
+		# committing touches the chunk, so it is only known to be in the db after the next save
+		self.pool.save_changes()
+		self.pool.save_changes()
+		
+		self.pool.expire(self.now + 25)
+		self.assertIn(A, self.pool._chunks)
+		self.pool.expire(self.now + 31)
+		self.assertNotIn(A, self.pool._chunks)
+	
+	def test_old_entries_are_ignored(self):
+		self.pool.load_list([A])
+		self.pool.unload(A)
+		self.pool.load_list([A])
+		self.assertEqual(len(self.pool._expiry), 2)
+		
+		self.pool.expire(self.now + 20)
+		self.assertNotIn(A, self.pool._chunks)
+		self.assertEqual(self.pool.stats()["pool_expirations"], 1)
+
+class TestRecoverJournals(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.dbfile = os.path.join(self.directory.name, "world.db")
+	
+	def tearDown(self):
+		self.directory.cleanup()
+	
+	def crash(self, journal_name, d):
+		"""
+		Write to the db through the journal, and stop before the changes are saved.
+		"""
+		
+		pool = DBChunkPool(self.dbfile, journal_name=journal_name)
+		pool.write_diffs({A: ChunkDiff.from_dict(d)})
+		pool._journal._close_file()
+		pool._chunkdb.close()
+	
+	def content(self):
+		pool = DBChunkPool(self.dbfile, journal=False)
+		try:
+			diffs, versions = pool.read_chunks([A])
+			return diffs[A].to_string()[:2]
+		finally:
+			pool.close()
+	
+	def test_journal_names(self):
+		for name in ("world.db-edits.1", "world.db-shard2-edits.3", "world.db-shard2-edits.4",
+				"world.db-shardx-edits.1", "world.db-edits.x", "world.db-other-edits.1", "other.db-edits.1"):
+			open(os.path.join(self.directory.name, name), "w").close()
+		
+		self.assertEqual(journal_names(self.dbfile), [self.dbfile, shard_journal_name(self.dbfile, 2)])
+	
+	def test_all_modes_are_recovered(self):
+		self.crash(shard_journal_name(self.dbfile, 0), {0: "a"})
+		self.crash(self.dbfile, {1: "b"})
+		
+		recover_journals(self.dbfile)
+		self.assertEqual(journal_names(self.dbfile), [])
+		self.assertEqual(self.content(), "ab")
+	
+	def test_old_journals_are_not_replayed_later(self):
+		# crash while sharded, then serve unsharded
+		self.crash(shard_journal_name(self.dbfile, 1), {0: "a"})
+		recover_journals(self.dbfile)
+		
+		pool = DBChunkPool(self.dbfile)
+		pool.write_diffs({A: ChunkDiff.from_dict({0: "b"})})
+		pool.save_changes()
+		pool.close()
+		
+		# and sharded again
+		recover_journals(self.dbfile)
+		self.assertEqual(self.content(), "b ")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from chunks import ChunkDiff
+from dbchunkpool import DBChunkPool
+from journal import DiffJournal
+from utils import Position
+
+class TestDiffJournal(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.basename = os.path.join(self.directory.name, "world.db")
+	
+	def tearDown(self):
+		self.directory.cleanup()
+	
+	def test_read_in_order(self):
+		journal = DiffJournal(self.basename)
+		appended = [{Position(i, 0): ChunkDiff.from_dict({i: "ä"})} for i in range(3)]
+		for diffs in appended:
+			journal.append(diffs)
+		journal.close()
+		
+		journal = DiffJournal(self.basename)
+		segment, = journal.segments()[:-1]
+		read = [{pos: diff.to_dict() for pos, diff in diffs.items()} for diffs in journal.read(segment)]
+		self.assertEqual(read, [{pos: diff.to_dict() for pos, diff in diffs.items()} for diffs in appended])
+		journal.close()
+	
+	def test_cut_off_line(self):
+		journal = DiffJournal(self.basename)
+		journal.append({Position(0, 0): ChunkDiff.from_dict({0: "a"})})
+		journal.close()
+		
+		journal = DiffJournal(self.basename)
+		segment = journal.segments()[0]
+		with open("{}-edits.{}".format(self.basename, segment), "ab") as f:
+			# half of a multibyte UTF-8 sequence
+			f.write('[[[1, 0], {"0": "ä'.encode("utf-8")[:-1])
+		
+		read = list(journal.read(segment))
+		journal.close()
+		self.assertEqual(len(read), 1)
+		self.assertEqual(read[0][Position(0, 0)].to_dict(), {0: "a"})
+	
+	def test_replay(self):
+		pool = DBChunkPool(self.basename)
+		pool.write_diffs({Position(0, 0): ChunkDiff.from_dict({0: "a"})})
+		pool.write_diffs({Position(0, 0): ChunkDiff.from_dict({1: "b"})})
+		pool._journal.sync()
+		# crash: neither saved nor closed
+		
+		pool = DBChunkPool(self.basename)
+		chunk = pool.get(Position(0, 0))
+		self.assertEqual(chunk.to_string()[:2], "ab")
+		self.assertEqual(chunk.version, 2)
+		pool.close()
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,122 @@
+import struct
+import unittest
+
+import protocol
+from chunks import CHUNK_SIZE, ChunkDiff, pack_diffs, unpack_diffs, pack_coords, unpack_coords
+from utils import Position
+
+def sample_diffs():
+	full = ChunkDiff.from_string("ab" + " "*(CHUNK_SIZE - 3) + "\U0001f600")
+	return {
+		Position(0, 0): ChunkDiff.from_dict({0: "a", 3: " ", 100: "ä"}),
+		Position(-1, 2**20): full,
+		Position(5, -5): ChunkDiff(),
+	}
+
+class TestDiffBytes(unittest.TestCase):
+	def assert_same_diffs(self, diffs, other):
+		self.assertEqual(set(diffs), set(other))
+		for pos, diff in diffs.items():
+			self.assertEqual(other[pos].to_dict(), diff.to_dict())
+	
+	def test_round_trip(self):
+		for diff in sample_diffs().values():
+			data = diff.to_bytes()
+			decoded, offset = ChunkDiff.from_bytes(b"xx" + data, 2)
+			self.assertEqual(offset, len(data) + 2)
+			self.assertEqual(decoded.to_dict(), diff.to_dict())
+	
+	def test_full_diff_leaves_out_blanks(self):
+		full = sample_diffs()[Position(-1, 2**20)]
+		partial = ChunkDiff.from_dict({0: "a", 1: "b", CHUNK_SIZE - 1: "\U0001f600"})
+		self.assertEqual(len(full.to_bytes()), len(partial.to_bytes()))
+	
+	def test_malformed(self):
+		data = sample_diffs()[Position(0, 0)].to_bytes()
+		for broken in (data[:1], data[:-1], b"\x07" + data[1:]):
+			with self.assertRaises(ValueError):
+				ChunkDiff.from_bytes(broken)
+	
+	def test_malformed_indices(self):
+		for indices in ((3, 2), (1, 1), (CHUNK_SIZE,)):
+			data = struct.pack("<BH{}HH".format(len(indices)), 2, len(indices), *indices, len(indices)) + b"a"*len(indices)
+			with self.assertRaises(ValueError):
+				ChunkDiff.from_bytes(data)
+		
+		data = struct.pack("<BHHHH", 2, 2, 2, 3, 2) + b"ab"
+		self.assertEqual(ChunkDiff.from_bytes(data)[0].to_dict(), {2: "a", 3: "b"})
+	
+	def test_pack_diffs(self):
+		diffs = sample_diffs()
+		self.assert_same_diffs(diffs, unpack_diffs(pack_diffs(diffs)))
+		
+		versions = {pos: (i - 1, i + 3) for i, pos in enumerate(diffs)}
+		unpacked_versions = {}
+		self.assert_same_diffs(diffs, unpack_diffs(pack_diffs(diffs, versions), 0, unpacked_versions))
+		self.assertEqual(unpacked_versions, versions)
+		
+		with self.assertRaises(ValueError):
+			unpack_diffs(pack_diffs(diffs, versions)[:-1], 0, {})
+	
+	def test_pack_coords(self):
+		coords = [Position(0, 0), Position(-3, 7), Position(2**31 - 1, -2**31)]
+		self.assertEqual(unpack_coords(pack_coords(coords)), coords)
+		
+		versions = {Position(-3, 7): (4, 2**32 - 1)}
+		unpacked_versions = {}
+		self.assertEqual(unpack_coords(pack_coords(coords, versions), 0, unpacked_versions), coords)
+		self.assertEqual(unpacked_versions, versions)
+		
+		with self.assertRaises(ValueError):
+			unpack_coords(pack_coords(coords)[:-1])
+
+class TestMessages(unittest.TestCase):
+	def test_binary_and_json_agree(self):
+		diffs = sample_diffs()
+		versions = {pos: (1, 2) for pos in diffs}
+		messages = [
+			("apply-changes", diffs, versions),
+			("apply-changes", diffs, None),
+			("save-changes", diffs, None),
+			("request-chunks", [Position(1, 2), Position(3, 4)], {Position(3, 4): (7, 8)}),
+			("unload-chunks", [Position(1, 2)], None),
+		]
+		
+		for mtype, data, versions in messages:
+			for message in (protocol.encode_binary(mtype, data, versions), protocol.encode_json(mtype, data, versions)):
+				dtype, ddata, dversions = protocol.decode(message)
+				self.assertEqual(dtype, mtype)
+				self.assertEqual(dversions, versions or {})
+				if mtype in protocol.DIFF_MESSAGES:
+					self.assertEqual({pos: diff.to_dict() for pos, diff in ddata.items()}, {pos: diff.to_dict() for pos, diff in data.items()})
+				else:
+					self.assertEqual(ddata, data)
+	
+	def test_binary_is_smaller(self):
+		pos = Position(-3, 1000)
+		diffs = [
+			ChunkDiff.from_dict({5: "a"}), # a single typed character
+			ChunkDiff.from_dict({i: "a" for i in range(40, 70)}),
+			ChunkDiff.from_dict({i: "a" for i in range(0, CHUNK_SIZE, 2)}),
+			ChunkDiff(),
+			ChunkDiff.from_string(" "*CHUNK_SIZE), # an empty chunk
+			ChunkDiff.from_string("a"*CHUNK_SIZE),
+		]
+		
+		for diff in diffs:
+			for versions in (None, {pos: (1000, 1001)}):
+				binary = protocol.encode_binary("apply-changes", {pos: diff}, versions)
+				text = protocol.encode_json("apply-changes", {pos: diff}, versions)
+				self.assertLess(len(binary), len(text)/2, diff)
+		
+		# the type, position and diff header, but no mask
+		self.assertLessEqual(len(protocol.encode_binary("apply-changes", {pos: diffs[0]})), 20)
+	
+	def test_unknown_type(self):
+		with self.assertRaises(ValueError):
+			protocol.decode(b"\xff")
+		with self.assertRaises(ValueError):
+			protocol.decode(b"")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,77 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+
+try:
+	import shardserver
+except ImportError:
+	shardserver = None
+
+from chunks import ChunkDiff
+from dbchunkpool import DBChunkPool, shard_journal_name
+from subscriptions import SubscriptionIndex
+from utils import Position
+
+@unittest.skipUnless(shardserver, "websockets is not available")
+class TestShardedPool(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.dbfile = os.path.join(self.directory.name, "world.db")
+	
+	def tearDown(self):
+		self.directory.cleanup()
+	
+	def test_invalid_number_of_shards(self):
+		with self.assertRaises(ValueError):
+			shardserver.ShardedPool(self.dbfile, 0)
+		
+		for shards in ("0", "-1", "x"):
+			out = io.StringIO()
+			with redirect_stdout(out):
+				shardserver.main(["shardserver.py", self.dbfile, "8000", "0", shards])
+			self.assertIn("Invalid number of shards", out.getvalue())
+	
+	def test_recovers_journals_of_removed_shards(self):
+		# a shard that isn't going to exist anymore crashed with unsaved changes
+		pool = DBChunkPool(self.dbfile, journal_name=shard_journal_name(self.dbfile, 3))
+		pool.write_diffs({Position(0, 0): ChunkDiff.from_dict({0: "a"})})
+		pool._journal.sync()
+		
+		sharded = shardserver.ShardedPool(self.dbfile, 1)
+		try:
+			diffs, versions = sharded.read_chunks([Position(0, 0)])
+			self.assertEqual(diffs[Position(0, 0)].to_string()[:2], "a ")
+		finally:
+			sharded.close()
+		
+		self.assertEqual([name for name in os.listdir(self.directory.name) if "shard3" in name], [])
+
+	def test_subscribed_chunks_are_not_expired(self):
+		sharded = shardserver.ShardedPool(self.dbfile, 2)
+		try:
+			subscriptions = SubscriptionIndex()
+			sharded.follow(subscriptions)
+			
+			coords = [Position(0, 0), Position(16, 0), Position(32, 0), Position(48, 0)]
+			# the subscribed chunks belong to different shards
+			self.assertEqual({sharded.shard_of(pos) for pos in coords[:2]}, {0, 1})
+			
+			subscriptions.subscribe("client", coords[:2])
+			sharded.read_chunks(coords)
+			
+			sharded.expire(time.time() + 3600)
+			stats = sharded.stats()
+			self.assertEqual(stats["chunks"], 2)
+			self.assertEqual(stats["pool_expirations"], 2)
+			
+			subscriptions.unsubscribe("client", coords[:1])
+			sharded.expire(time.time() + 7200)
+			self.assertEqual(sharded.stats()["chunks"], 1)
+		finally:
+			sharded.close()
+
+if __name__ == "__main__":
+	unittest.main()
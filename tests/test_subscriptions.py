@@ -0,0 +1,74 @@
+import threading
+import unittest
+
+from subscriptions import SubscriptionIndex
+from utils import Position
+
+A, B, C = Position(0, 0), Position(1, 0), Position(0, 1)
+
+class TestSubscriptionIndex(unittest.TestCase):
+	def setUp(self):
+		self.index = SubscriptionIndex()
+	
+	def test_distribute(self):
+		self.index.subscribe("x", [A, B])
+		self.index.subscribe("y", [B, C])
+		
+		self.assertEqual(self.index.distribute({A: 1, B: 2, Position(5, 5): 3}), {
+			"x": {A: 1, B: 2},
+			"y": {B: 2},
+		})
+		self.assertEqual(self.index.distribute({}), {})
+	
+	def test_unsubscribe(self):
+		self.index.subscribe("x", [A, B])
+		self.index.subscribe("y", [B])
+		
+		self.index.unsubscribe("x", [A, B, C])
+		self.assertFalse(self.index.subscribed(A))
+		self.assertTrue(self.index.subscribed(B))
+		self.assertEqual(self.index.distribute({A: 1, B: 2}), {"y": {B: 2}})
+		
+		# positions without subscribers are forgotten
+		self.index.unsubscribe("y", [B])
+		self.assertEqual(self.index._subscribers, {})
+	
+	def test_subscribe_twice(self):
+		self.index.subscribe("x", [A])
+		self.index.subscribe("x", [A])
+		self.assertEqual(self.index.distribute({A: 1}), {"x": {A: 1}})
+		
+		self.index.unsubscribe("x", [A])
+		self.assertFalse(self.index.subscribed(A))
+	
+	def test_hooks(self):
+		calls = []
+		self.index.first_subscribed = lambda coords: calls.append(("first", sorted(coords)))
+		self.index.last_unsubscribed = lambda coords: calls.append(("last", sorted(coords)))
+		
+		self.index.subscribe("x", [A, B])
+		self.index.subscribe("y", [B, C])
+		self.index.unsubscribe("x", [A, B])
+		self.index.unsubscribe("y", [B, C])
+		
+		self.assertEqual(calls, [("first", [A, B]), ("first", [C]), ("last", [A]), ("last", sorted([B, C]))])
+	
+	def test_concurrent(self):
+		coords = [Position(x, 0) for x in range(50)]
+		
+		def churn(conn):
+			for _ in range(100):
+				self.index.subscribe(conn, coords)
+				self.index.distribute({pos: None for pos in coords})
+				self.index.unsubscribe(conn, coords)
+		
+		workers = [threading.Thread(target=churn, args=(n,)) for n in range(4)]
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+		
+		self.assertEqual(self.index._subscribers, {})
+
+if __name__ == "__main__":
+	unittest.main()